@@ -24,13 +24,15 @@ __version__ = (1,0,0,__release_type__)
 del __release_type__
 __author__ = "zombraxi"
 
+# only modules the interpreter has loaded anyway are imported up front,
+# everything else is imported where it's needed so that e.g. --help
+# and --new start fast. typing is only needed for the annotations
 import os
 import sys
-import re
 import io
-from enum import Enum, auto
-from typing import List, Tuple
-from dataclasses import dataclass
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import List, Tuple, NoReturn
 
 """
 
@@ -38,10 +40,15 @@ Useful base class wrappers
 
 """
 class SingletonBase(object):
+    # empty so that subclasses may use __slots__, the ones
+    # that don't still get a __dict__ as usual
+    __slots__=()
     single_instance = None
 
     def __new__(cls, *args):
-        if cls.__is_instantiated(): return cls.single_instance
+        # every Logger() etc. comes through here, keep it short
+        inst = cls.single_instance
+        if inst != None: return inst
 
         NO_LOGGER_PRINT("SingletonBase.__new__",
             "Creating a new instance of {}".format(cls.__name__))
@@ -51,7 +58,7 @@ class SingletonBase(object):
         # MUST CHECK IN __INIT__,
         # AFTER __NEW__ RETURNS, IT RUNS __INIT__
         # AND DONT WANT THE OBJECT REINITIALIZING ITS VALUES !!
-        if self.__is_self_instantiated(): return # self.__self_inst()
+        if self.__class__.single_instance is self: return # self.__self_inst()
                                                 # __init__ can only ret None
 
         # cant use Logger here because Logger inherits from SingletonBase
@@ -93,10 +100,12 @@ class SingletonBase(object):
     def __set_inst(self) -> None:
         self.__class__.single_instance = self
 
-class WEnum(Enum):
+# plain class attributes rather than an Enum, importing enum is
+# noticeable at startup
+class WEnum(object):
     @classmethod
     def get( cls, attrib: str ):
-        return cls.__dict__[attrib].value
+        return getattr(cls, attrib)
 
 class TypedVar(object):
     __name__ ='TypedVar'
@@ -207,38 +216,93 @@ class Union(object):
 Logging mechanism
 
 """
+# prints without a Logger (SingletonBase can't use one, the Logger being
+# a singleton too), but still only at the DEBUG level
 def NO_LOGGER_PRINT(func_name="DEBUG", text="") -> None:
     ASSERT_STR(func_name)
     ASSERT_STR(text)
 
-    if (__debug__):
+    if (__debug__) and Logger.level <= LogLevel.DEBUG:
         print(
             "FUNCTION {} : {}".format(func_name, text)
         )
 
+class LogLevel(WEnum):
+    DEBUG: int = 10
+    INFO: int = 20
+    WARNING: int = 30
+    ERROR: int = 40
+    NAMES = ("DEBUG","INFO","WARNING","ERROR")
+
+    @classmethod
+    def from_name(cls, name: str) -> int:
+        name = str(name).upper()
+        if name not in cls.NAMES:
+            raise InvalidArgumentError(
+                "unknown log level {!r}, expected one of {}".format(
+                    name, ", ".join(cls.NAMES)))
+        return cls.get(name)
+
+    @classmethod
+    def name_of(cls, level: int) -> str:
+        for name in cls.NAMES:
+            if cls.get(name) == level:
+                return name
+        return str(level)
+
+# Records are kept unformatted, as (level, func_name, text, args), in a
+# ring buffer holding the last LogRingSize of them; `text.format(*args)`
+# only happens once a record is actually printed or dumped. Anything
+# below `level` is dropped straight away, and in release builds
+# (`-OO`) nothing is logged at all. `level` belongs to the class, so
+# it can be set (see apply_log_level) before the Logger is created
 class Logger(SingletonBase):
+    level: int = LogLevel.DEBUG
 
     # override singletonbase...
     def __SINGLETON_INIT__(self):
-        self.GLOBAL_LOG: str = ""
+        import threading
+        from collections import deque
+        self.records = deque(maxlen=HGenEnvars.get("LogRingSize"))
+        # headers may be written from a worker pool (see --jobs)
+        self.__lock = threading.Lock()
+
+    def enabled_for(self, level: int) -> bool:
+        return __debug__ and level >= self.level
 
-    def add_to_log(self, t: str) -> None:
+    def add_to_log(self, t: str, level: int = None) -> None:
         if (__debug__):
-            self.GLOBAL_LOG += "{}\n".format(t)
+            self.records.append((level or LogLevel.get("DEBUG"), None, t, ()))
 
-    def print(self, func_name: str = None, text: str = "") -> None:
-        assert type(func_name) is str or func_name is None, "func_name must be `str`"
-        ASSERT_STR(text)
+    def print(self, func_name: str = None, text: str = "", *args,
+        level: int = LogLevel.DEBUG) -> None:
         if (__debug__):
-            text = "FUNCTION {}: {}".format(func_name,text) if (func_name != None) else (
-                "DEBUG: {}".format(text)
-            )
-            print(text)
-            self.add_to_log(text)
+            if level < self.level:
+                return
+            rec = (level, func_name, text, args)
+            self.records.append(rec) # deque appends are thread-safe
+            line = self.format(rec)
+            with self.__lock: # keep lines whole when printing from workers
+                print(line)
+
+    @staticmethod
+    def format(rec: tuple) -> str:
+        level, func_name, text, args = rec
+        if args:
+            text = text.format(*args)
+        if func_name == None:
+            return "{}: {}".format(LogLevel.name_of(level), text)
+        if level == LogLevel.get("DEBUG"):
+            return "FUNCTION {}: {}".format(func_name, text)
+        return "{} FUNCTION {}: {}".format(LogLevel.name_of(level), func_name, text)
 
     def dump(self) -> None:
         if (__debug__):
-            Swrite_to("headergen_log_dump.txt",self.GLOBAL_LOG)
+            # written a record at a time rather than as one big string
+            with io.open("headergen_log_dump.txt", "w") as f:
+                for rec in list(self.records):
+                    f.write(self.format(rec))
+                    f.write("\n")
 
 
 """
@@ -287,6 +351,28 @@ Errors
 class InvalidActionError(Exception):
     pass
 
+class InvalidArgumentError(Exception):
+    pass
+
+# raised by the script parser, always carries where it happened
+class HGenSyntaxError(Exception):
+    def __init__(self, message: str, source: str, line: int, col: int):
+        self.source = source
+        self.line = line
+        self.col = col
+        super().__init__(
+            "{}:{}:{}: {}".format(source, line, col, message)
+        )
+
+# raised once every header of a GENERATE_HEADERS call has been attempted,
+# carrying a (filepath, exception) pair for each one that failed
+class HeaderWriteError(Exception):
+    def __init__(self, failures: List[Tuple[str, Exception]]):
+        self.failures = failures
+        super().__init__(
+            "{} header(s) failed to generate".format(len(failures))
+        )
+
 class UnknownError(Exception):
     def __init__(self):
         super().__init__(
@@ -295,29 +381,663 @@ class UnknownError(Exception):
 
 """
 
+Profiling
+
+"""
+
+# Per-phase wall time, call counts, bytes read/written and traced
+# memory peak, collected while --profile is on. Unlike the Logger this
+# also works in release (-OO) builds. Instrumented code checks the
+# class-level `enabled` flag first, so it costs next to nothing when off
+class Profiler(SingletonBase):
+    enabled: bool = False
+
+    def __SINGLETON_INIT__(self):
+        # name -> [calls, wall_s, bytes_read, bytes_written, peak_bytes]
+        self.phases = {}
+        self.events = [] # Chrome trace "complete" events
+        self.trace: bool = False
+        self.started: float = 0.0
+        self.wall: float = 0.0
+        self.__memory: bool = False
+        import threading
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+
+    def start(self, trace: bool = False, memory: bool = True) -> None:
+        import time
+        import tracemalloc
+        self.trace = trace
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__memory = True
+        self.started = time.perf_counter()
+        Profiler.enabled = True
+
+    def stop(self) -> None:
+        import time
+        import tracemalloc
+        Profiler.enabled = False
+        self.wall = time.perf_counter() - self.started
+        if self.__memory:
+            tracemalloc.stop()
+            self.__memory = False
+
+    # drop everything collected so far (pool workers do this per script)
+    def reset(self) -> None:
+        with self.__lock:
+            self.phases = {}
+            self.events = []
+
+    def phase(self, name: str) -> ProfilePhase:
+        return ProfilePhase(self, name)
+
+    # open phases of the calling thread, innermost last
+    def stack(self) -> List[ProfilePhase]:
+        stack = getattr(self.__local, "stack", None)
+        if stack == None:
+            stack = self.__local.stack = []
+        return stack
+
+    def add_bytes(self, read: int = 0, written: int = 0) -> None:
+        stack = self.stack()
+        if stack:
+            stack[-1].bytes_read += read
+            stack[-1].bytes_written += written
+
+    def record(self, ph: ProfilePhase, wall: float) -> None:
+        with self.__lock:
+            entry = self.phases.get(ph.name)
+            if entry == None:
+                entry = self.phases[ph.name] = [0, 0.0, 0, 0, 0]
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += ph.bytes_read
+            entry[3] += ph.bytes_written
+            entry[4] = max(entry[4], ph.peak)
+            if self.trace and len(self.events) < HGenEnvars.get("ProfileMaxTraceEvents"):
+                import threading
+                self.events.append({
+                    "name":ph.name, "ph":"X",
+                    "ts":ph.start * 1e6, "dur":wall * 1e6,
+                    "pid":os.getpid(), "tid":threading.get_ident(),
+                })
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                "phases":{k: list(v) for k, v in self.phases.items()},
+                "events":list(self.events),
+            }
+
+    # folds in a snapshot taken in another (worker) process
+    def merge(self, snap: dict) -> None:
+        with self.__lock:
+            for name, (calls, wall, rd, wr, peak) in snap["phases"].items():
+                entry = self.phases.get(name)
+                if entry == None:
+                    entry = self.phases[name] = [0, 0.0, 0, 0, 0]
+                entry[0] += calls
+                entry[1] += wall
+                entry[2] += rd
+                entry[3] += wr
+                entry[4] = max(entry[4], peak)
+            self.events.extend(snap["events"])
+
+    def summary(self) -> str:
+        lines = [
+            "Profile: {:.3f}s wall".format(self.wall),
+            "{:<36} {:>9} {:>11} {:>12} {:>12} {:>10}".format(
+                "phase", "calls", "wall ms", "read B", "written B", "peak KiB"),
+        ]
+        for name, (calls, wall, rd, wr, peak) in sorted(
+            self.phases.items(), key=lambda kv: -kv[1][1]):
+            lines.append("{:<36} {:>9} {:>11.2f} {:>12} {:>12} {:>10.1f}".format(
+                name, calls, wall * 1e3, rd, wr, peak / 1024))
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        return {
+            "wall_s":self.wall,
+            "phases":{
+                name:{
+                    "calls":calls, "wall_s":wall, "bytes_read":rd,
+                    "bytes_written":wr, "peak_bytes":peak,
+                }
+                for name, (calls, wall, rd, wr, peak) in self.phases.items()
+            },
+        }
+
+    def to_chrome_trace(self) -> dict:
+        return {"traceEvents":self.events, "displayTimeUnit":"ms"}
+
+    def write_json(self, filepath: str, dat: dict) -> None:
+        import json
+        with io.open(filepath, "w") as f:
+            json.dump(dat, f)
+
+# one timed run of a phase, used as a context manager
+class ProfilePhase(object):
+    __name__='ProfilePhase'
+    __slots__=('profiler','name','start','base','peak',
+        'bytes_read','bytes_written',)
+
+    def __init__(self, profiler: Profiler, name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.bytes_read: int = 0
+        self.bytes_written: int = 0
+        self.base: int = 0
+        self.peak: int = 0
+
+    def __enter__(self) -> ProfilePhase:
+        import time
+        import tracemalloc
+        stack = self.profiler.stack()
+        if tracemalloc.is_tracing():
+            cur, peak = tracemalloc.get_traced_memory()
+            # the global peak is about to be reset, so hand the peak so
+            # far to every phase that is still open
+            for outer in stack:
+                outer.peak = max(outer.peak, peak - outer.base)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            self.base = cur
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        import time
+        import tracemalloc
+        wall = time.perf_counter() - self.start
+        stack = self.profiler.stack()
+        stack.pop()
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak = max(self.peak, peak - self.base)
+            for outer in stack:
+                outer.peak = max(outer.peak, peak - outer.base)
+        self.profiler.record(self, wall)
+
+# times every call of the decorated function as phase `name`
+# whenever the Profiler is enabled
+def profiled(name: str):
+    def decorate(fn):
+        def wrapper(*args, **kwargs):
+            if not Profiler.enabled:
+                return fn(*args, **kwargs)
+            with Profiler().phase(name):
+                return fn(*args, **kwargs)
+        # what functools.wraps would do, without importing it at startup
+        wrapper.__name__ = fn.__name__
+        wrapper.__qualname__ = fn.__qualname__
+        wrapper.__doc__ = fn.__doc__
+        wrapper.__wrapped__ = fn
+        return wrapper
+    return decorate
+
+"""
+
 File I/O wrappers
 
 """
-def Swrite_to(filepath: str, text: str) -> None:
+# how hard a write tries to reach the disk before returning:
+#     none - leave it to the OS (the default, fine for throwaway CI disks)
+#     file - fsync every file, and its directory, as it's written
+#     batch - nothing per file, every file written is fsync'ed once the
+#             script (or a whole batch of scripts) has run
+#             (see sync_outputs)
+DURABILITY_MODES: Tuple[str, ...] = ("none", "file", "batch")
+
+_temp_counter = 0
+
+# writes dat to filepath atomically: the bytes go to a temporary file
+# next to it which then replaces filepath, so an interrupted run never
+# leaves a truncated file behind, only the old one
+def Swrite_bytes_to(filepath: str, dat: bytes, durability: str = "none") -> None:
+    global _temp_counter
+    # replace what a symlink points to, not the symlink itself
+    if os.path.islink(filepath):
+        filepath = os.path.realpath(filepath)
+    dirname, basename = os.path.split(filepath)
+
+    # O_EXCL so that concurrent writers never share a temporary file,
+    # 0o666 so the umask applies just like it does for io.open
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    while True:
+        _temp_counter += 1
+        tmppath = os.path.join(dirname, ".{}.{}.{}.tmp".format(
+            basename, os.getpid(), _temp_counter))
+        try:
+            fd = os.open(tmppath, flags, 0o666)
+            break
+        except FileExistsError:
+            continue
+        except OSError as err: # about filepath, not our temporary name
+            raise OSError(err.errno, err.strerror, filepath) from None
+
+    try:
+        with io.open(fd, "wb") as f:
+            f.write(dat)
+            if durability == "file":
+                f.flush()
+                os.fsync(f.fileno())
+        # rewriting a file in place kept its permissions, so do the same
+        try:
+            os.chmod(tmppath, os.stat(filepath).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmppath, filepath)
+    except BaseException: # KeyboardInterrupt too
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+
+    if durability == "file":
+        Sfsync_directory(dirname)
+
+@profiled("Swrite_to")
+def Swrite_to(filepath: str, text: str, durability: str = "none") -> None:
+    ASSERT_STR(text)
+    ASSERT_STR(filepath)
+
+    if (__debug__):
+        Logger().print("Swrite_to","Writing to {}",filepath)
+
+    dat = Sencode_text(text)
+    Swrite_bytes_to(filepath, dat, durability)
+    if Profiler.enabled:
+        Profiler().add_bytes(written=len(dat))
+
+# makes a rename in dirname durable. directories can't be opened
+# (or fsync'ed) on Windows, where os.replace is durable on its own
+def Sfsync_directory(dirname: str) -> None:
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(dirname or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# the "batch" durability: fsyncs each of filepaths, then each of their
+# directories, each only once. just these files, not everything else
+# waiting to be written back on the host. Windows can only flush a
+# file opened for writing, elsewhere a read-only header can be flushed
+@profiled("sync_outputs")
+def sync_outputs(filepaths: List[str]) -> None:
+    if not filepaths:
+        return
+    filepaths = list(dict.fromkeys(filepaths)) # written by several scripts
+    if (__debug__):
+        Logger().print("sync_outputs","Syncing {} file(s)",len(filepaths))
+    flags = (os.O_RDWR if os.name == "nt" else os.O_RDONLY) | getattr(
+        os, "O_BINARY", 0)
+    dirs = set()
+    for p in filepaths:
+        fd = os.open(p, flags)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        dirs.add(os.path.dirname(p))
+    for d in dirs:
+        Sfsync_directory(d)
+
+def parse_seconds_value(v: str) -> float:
+    try:
+        seconds = float(v)
+    except (TypeError, ValueError):
+        seconds = -1.0
+    if not (seconds >= 0): # NaN too
+        raise InvalidArgumentError(
+            "expected a number of seconds, got {!r}".format(v)
+        )
+    return seconds
+
+def parse_durability_value(v: str) -> str:
+    if v not in DURABILITY_MODES:
+        raise InvalidArgumentError(
+            "durability must be one of {}, got {!r}".format(
+                ", ".join(DURABILITY_MODES), v)
+        )
+    return v
+
+# encodes text exactly the way a text-mode io.open(..., "w") would
+# (locale encoding, newline translation), so it can be compared with
+# what is already on disk
+def Sencode_text(text: str) -> bytes:
+    buf = io.BytesIO()
+    w = io.TextIOWrapper(buf)
+    w.write(text)
+    w.flush()
+    dat = buf.getvalue()
+    w.detach()
+    return dat
+
+# writes text unless filepath already holds exactly that content,
+# returns whether the file was (re)written
+@profiled("Swrite_if_changed")
+def Swrite_if_changed(filepath: str, text: str,
+    durability: str = "none") -> bool:
     ASSERT_STR(text)
     ASSERT_STR(filepath)
 
-    Logger().print("Swrite_to","Writing to {}".format(filepath))
+    try:
+        size = os.stat(filepath).st_size
+    except OSError:
+        size = -1
+
+    dat = Sencode_text(text)
+    if size != -1 and Sis_same_on_disk(filepath, dat, size):
+        return False
+
+    if (__debug__):
+        Logger().print("Swrite_if_changed","Writing to {}",filepath)
+    Swrite_bytes_to(filepath, dat, durability)
+    if Profiler.enabled:
+        Profiler().add_bytes(written=len(dat))
+    return True
 
-    f = io.open(filepath, "w")
-    f.write(text)
+# whether filepath (of `size` bytes) holds exactly dat
+def Sis_same_on_disk(filepath: str, dat: bytes, size: int) -> bool:
+    # cheap size check before reading anything back
+    if size != len(dat):
+        return False
+    f = io.open(filepath, "rb")
+    same = (f.read() == dat)
     f.close()
+    if Profiler.enabled:
+        Profiler().add_bytes(read=size)
+    if same and (__debug__):
+        Logger().print("Swrite_if_changed","{} is unchanged, skipping",filepath)
+    return same
+
+def Sdigest(dat: bytes) -> bytes:
+    import hashlib
+    return hashlib.blake2b(dat, digest_size=16).digest()
+
+# Swrite_if_changed for runs tracked by the BuildIndex: also returns the
+# file's (size, mtime_ns, digest) afterwards. when that matches `known`
+# (the same from the last run) the file isn't read back at all
+@profiled("Swrite_if_changed")
+def Swrite_tracked(filepath: str, text: str, durability: str = "none",
+    known: tuple = None) -> Tuple[bool, tuple]:
+    ASSERT_STR(text)
+    ASSERT_STR(filepath)
+
+    dat = Sencode_text(text)
+    digest = Sdigest(dat)
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        st = None
+
+    if st != None:
+        fp = (st.st_size, st.st_mtime_ns, digest)
+        if fp == known:
+            if (__debug__):
+                Logger().print("Swrite_tracked",
+                    "{} is unchanged since the last run, skipping",filepath)
+            return (False, fp)
+        if Sis_same_on_disk(filepath, dat, st.st_size):
+            return (False, fp)
 
+    if (__debug__):
+        Logger().print("Swrite_tracked","Writing to {}",filepath)
+    Swrite_bytes_to(filepath, dat, durability)
+    if Profiler.enabled:
+        Profiler().add_bytes(written=len(dat))
+    st = os.stat(filepath)
+    return (True, (st.st_size, st.st_mtime_ns, digest))
+
+# Sread_from for scripts too big to hold in memory: yields the file
+# in pieces of at most `size` characters
+def Sread_chunks(filepath: str, size: int = None):
+    ASSERT_STR(filepath)
+    if size == None:
+        size = HGenEnvars.get("StreamChunkSize")
+    if (__debug__):
+        Logger().print("Sread_chunks","Streaming from {}",filepath)
+    with io.open(filepath,"r") as f:
+        while True:
+            dat = f.read(size)
+            if not dat:
+                return
+            if Profiler.enabled:
+                Profiler().add_bytes(read=len(dat))
+            yield dat
+
+@profiled("Sread_from")
 def Sread_from(filepath: str) -> str:
     ASSERT_STR(filepath)
-    Logger().print("Sread_from","Reading from {}".format(filepath))
+    if (__debug__):
+        Logger().print("Sread_from","Reading from {}",filepath)
     f = io.open(filepath,"r")
     dat = f.read()
     f.close()
+    if Profiler.enabled:
+        Profiler().add_bytes(read=len(dat))
     return dat
 
 """
 
+License notice cache
+
+"""
+
+# License notice texts, shared by every script run in this process.
+# Keyed by absolute path and validated against the file's size and
+# mtime, so an edited notice is picked up. Files are read through mmap
+# and decoded once, the same way a text-mode read would decode them
+class LicenseCache(SingletonBase):
+
+    def __SINGLETON_INIT__(self):
+        self.entries = {} # abspath -> (size, mtime_ns, text)
+        self.hits: int = 0
+        self.misses: int = 0
+        self.__encoding: str = io.TextIOWrapper(io.BytesIO()).encoding
+        import threading
+        self.__lock = threading.Lock()
+
+    # returns (text, whether it came from the cache)
+    @profiled("LicenseCache.load")
+    def load(self, filepath: str) -> Tuple[str, bool]:
+        ASSERT_STR(filepath)
+        key = os.path.abspath(filepath)
+        st = os.stat(key)
+        entry = self.entries.get(key)
+        if entry != None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            with self.__lock:
+                self.hits += 1
+            if (__debug__):
+                Logger().print("LicenseCache.load","Hit for {}",filepath)
+            return (entry[2], True)
+
+        if (__debug__):
+            Logger().print("LicenseCache.load","Miss, mapping {}",filepath)
+        text = self.__read(key)
+        if Profiler.enabled:
+            Profiler().add_bytes(read=st.st_size)
+        with self.__lock:
+            self.misses += 1
+            self.entries[key] = (st.st_size, st.st_mtime_ns, text)
+        return (text, False)
+
+    def __read(self, filepath: str) -> str:
+        import mmap
+        f = io.open(filepath, "rb")
+        try:
+            # mmap can't map an empty file
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                text = str(mm, self.__encoding)
+            finally:
+                mm.close()
+        finally:
+            f.close()
+        # universal newlines, as io.open(filepath, "r") would do
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
+"""
+
+Header templates
+
+"""
+
+# A header layout, compiled once into literal text and {{SLOT}}s:
+#     LICENSE_BLOCK - the license notice inside a /* */ comment followed
+#                     by a blank line, or nothing without a notice
+#     LICENSE       - the bare license notice
+#     MACRO_PREFIX, FILE_PREFIX, FILE_EXT - the current settings
+#     GUARD         - the include guard, MACRO_PREFIX_NAME_H_
+#     NAME          - the header name given to GENERATE_HEADERS
+#     FILE          - the generated file's path, FILE_PREFIX+NAME.FILE_EXT
+class HeaderTemplate(object):
+    __name__='HeaderTemplate'
+    __slots__=('source','segments','__bound',)
+    SLOTS = (
+        "LICENSE_BLOCK","LICENSE","MACRO_PREFIX","FILE_PREFIX",
+        "FILE_EXT","GUARD","NAME","FILE"
+    )
+    DEFAULT = "{{LICENSE_BLOCK}}#ifndef {{GUARD}}\n#define {{GUARD}}\n\n#endif"
+    __default = None
+    __compiled = {} # template text -> HeaderTemplate
+
+    # segments are (is_slot, text) pairs
+    def __init__(self, segments: tuple, source: str = "<template>") -> None:
+        self.source = source
+        self.segments = segments
+        self.__bound = None
+
+    # what compile(DEFAULT) gives, spelled out so runs that don't
+    # parse anything (cached plans) never need `re`
+    @classmethod
+    def default(cls) -> HeaderTemplate:
+        if cls.__default == None:
+            cls.__default = cls((
+                (True,"LICENSE_BLOCK"),(False,"#ifndef "),(True,"GUARD"),
+                (False,"\n#define "),(True,"GUARD"),(False,"\n\n#endif")
+            ), "<default template>")
+        return cls.__default
+
+    @classmethod
+    def compile(cls, text: str, source: str = "<template>") -> HeaderTemplate:
+        ASSERT_STR(text)
+        tmpl = cls.__compiled.get(text)
+        if tmpl != None:
+            return tmpl
+
+        import re
+        segments = []
+        pos = 0
+        for mo in re.finditer(r'\{\{\s*([A-Za-z_]*)\s*\}\}', text):
+            if mo.group(1) not in cls.SLOTS:
+                line = text.count("\n", 0, mo.start()) + 1
+                col = mo.start() - (text.rfind("\n", 0, mo.start()) + 1) + 1
+                raise HGenSyntaxError(
+                    "unknown template slot {!r}, expected one of {}".format(
+                        mo.group(), ", ".join(cls.SLOTS)),
+                    source, line, col)
+            if mo.start() > pos:
+                segments.append((False, text[pos:mo.start()]))
+            segments.append((True, mo.group(1)))
+            pos = mo.end()
+        if pos < len(text):
+            segments.append((False, text[pos:]))
+
+        tmpl = cls(tuple(segments), source)
+        cls.__compiled[text] = tmpl
+        return tmpl
+
+    # the template as text, what compile() would turn back into it
+    def text(self) -> str:
+        return "".join(("{{"+text+"}}") if is_slot else text
+            for is_slot, text in self.segments)
+
+    # fills in every slot that is the same for the whole batch, leaving
+    # just the literal text around each occurrence of the header name.
+    # the last binding is remembered, so re-binding is free
+    def bind(self, macro_prefix: str, file_prefix: str,
+        file_ext: str, license_notice: str) -> BoundTemplate:
+        key = (macro_prefix, file_prefix, file_ext, license_notice)
+        last = self.__bound
+        if last != None and last[0] == key:
+            return last[1]
+
+        fext = ("."+file_ext) if (file_ext != "") else ""
+        values = {
+            "LICENSE_BLOCK":("/*\n{}\n*/\n\n".format(license_notice)
+                if license_notice != "" else ""),
+            "LICENSE":license_notice,
+            "MACRO_PREFIX":macro_prefix,
+            "FILE_PREFIX":file_prefix,
+            "FILE_EXT":file_ext,
+            # per-header slots, split around the name
+            "GUARD":(macro_prefix + "_", "_H_"),
+            "FILE":(file_prefix, fext),
+            "NAME":("", ""),
+        }
+        parts: List[str] = []
+        cur: List[str] = []
+        guards: List[int] = [] # the gaps between parts that are a GUARD's
+        for is_slot, text in self.segments:
+            v = values[text] if is_slot else text
+            if type(v) is tuple:
+                if is_slot and text == "GUARD":
+                    guards.append(len(parts))
+                cur.append(v[0])
+                parts.append("".join(cur))
+                cur = [v[1]]
+            else:
+                cur.append(v)
+        parts.append("".join(cur))
+
+        bound = BoundTemplate(tuple(parts), frozenset(guards))
+        self.__bound = (key, bound)
+        return bound
+
+# the header name as it goes into an include guard: every character
+# a macro name can't have becomes "_"
+def guard_name(xfile: str) -> str:
+    if xfile.isascii() and xfile.replace("_", "a").isalnum():
+        return xfile
+    return "".join(c if (c.isascii() and (c.isalnum() or c == "_")) else "_"
+        for c in xfile)
+
+# A HeaderTemplate with every batch-wide slot filled in: the literal
+# parts between occurrences of the header name
+# Attributes
+#     parts (tuple)
+#     guards (frozenset) - the gaps between parts that belong to a
+#         GUARD, filled with guard_name(name) rather than the name
+class BoundTemplate(object):
+    __name__='BoundTemplate'
+    __slots__=('parts','guards',)
+    def __init__(self, parts: tuple, guards: frozenset = frozenset()) -> None:
+        self.parts = parts
+        self.guards = guards
+
+    def render(self, xfile: str) -> str:
+        guard = guard_name(xfile) if self.guards else xfile
+        if guard is xfile: # the usual case, a name that is a valid macro
+            return xfile.join(self.parts)
+        parts = self.parts
+        out = [parts[0]]
+        for i in range(1, len(parts)):
+            out.append(guard if (i-1) in self.guards else xfile)
+            out.append(parts[i])
+        return "".join(out)
+
+"""
+
 HeaderGen data structures
 
 """
@@ -327,56 +1047,278 @@ HeaderGen data structures
 #     file_prefix (str)
 #     file_ext (str)
 #     license_notice (str)
-class HGenState(SingletonBase):
+#     jobs (int)
+#     template (HeaderTemplate)
+#     durability (str) - one of DURABILITY_MODES
+#     configurations (tuple) - (name, {setting: value}) of every
+#         CONFIGURATION, see variants()
+class HGenState(object):
     __name__='HGenState'
-    def __SINGLETON_INIT__(self) -> None:
-
-        # implicit Struct inheritance...
-        # singleton is incompatible with Struct so...
-        self.state = Struct()
-
-        """
-        macro_prefix - 0
-        file_prefix - 1
-        file_ext - 2
-        license_notice - 3
-        """
-        self.state.add_typed_var(str, "") # some reasonable defaults
-        self.state.add_typed_var(str, "")
-        self.state.add_typed_var(str, "H")
-        self.state.add_typed_var(str,"")
-
-    @property
-    def macro_prefix(self):
-        return self.state.get_var(0)
-
-    @macro_prefix.setter
-    def macro_prefix(self,v: str):
-        self.state.set_var(0,v)
-
-    @property
-    def file_prefix(self):
-        return self.state.get_var(1)
+    # plain slots rather than a Struct of TypedVars, these are read
+    # for every header. values are checked once, in set()
+    __slots__=('macro_prefix','file_prefix','file_ext','license_notice',
+        'jobs','template','durability','configurations',)
+    __types = {
+        "macro_prefix":str,
+        "file_prefix":str,
+        "file_ext":str,
+        "license_notice":str,
+        "jobs":int,
+        "template":HeaderTemplate,
+        "durability":str,
+        "configurations":tuple,
+    }
+    def __init__(self) -> None:
+        self.macro_prefix: str = "" # some reasonable defaults
+        self.file_prefix: str = ""
+        self.file_ext: str = "H"
+        self.license_notice: str = ""
+        self.jobs: int = 1 # serial unless asked otherwise
+        self.template: HeaderTemplate = HeaderTemplate.default()
+        self.durability: str = "none"
+        self.configurations: tuple = ()
+
+    # what the SET_* actions go through, the only place a setting's
+    # type is checked
+    def set(self, name: str, value: object) -> None:
+        t = self.__types.get(name)
+        if t == None:
+            raise AttributeError("HGenState has no setting {!r}".format(name))
+        if type(value) is not t:
+            raise TypeError("{} must be of type {}, got {}".format(
+                name, t.__name__, type(value).__name__))
+        setattr(self, name, value)
+
+    # every setting by name, e.g. to put them back later with update()
+    def settings(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def update(self, settings: dict) -> None:
+        for name, value in settings.items():
+            self.set(name, value)
+
+    # settings() as a string that is the same for equal settings,
+    # templates being compared by their text
+    def fingerprint(self) -> str:
+        def norm(settings: dict) -> tuple:
+            return tuple(sorted(
+                (name, value.text() if type(value) is HeaderTemplate
+                    else value)
+                for name, value in settings.items()
+                if name != "configurations"
+            ))
+        return repr((norm(self.settings()), tuple(
+            (name, norm(overrides))
+            for name, overrides in self.configurations
+        )))
+
+    # the template with this state's settings filled in
+    def bound_template(self) -> BoundTemplate:
+        return self.template.bind(
+            self.macro_prefix, self.file_prefix,
+            self.file_ext, self.license_notice
+        )
 
-    @file_prefix.setter
-    def file_prefix(self, v: str):
-        self.state.set_var(1,v)
+    # (bound template, file prefix, ".ext" or "") of every configuration,
+    # its settings being this state's with the configuration's on top
+    def variants(self) -> List[Tuple[BoundTemplate, str, str]]:
+        ret = []
+        for _, overrides in self.configurations:
+            get = lambda name: overrides.get(name, getattr(self, name))
+            fprfx = get("file_prefix")
+            fext = get("file_ext")
+            ret.append((
+                get("template").bind(get("macro_prefix"), fprfx, fext,
+                    get("license_notice")),
+                fprfx, ("."+fext) if (fext != "") else ""
+            ))
+        return ret
+
+    # the first two of configurations (this state's by default) that
+    # would write the same paths, as (name, name, "prefix", ".ext"), or
+    # None. such configurations only differ inside the headers and
+    # would overwrite each other's
+    def clashing_configurations(self,
+        configurations: tuple = None) -> tuple or None:
+        seen = {}
+        for name, overrides in (configurations if configurations != None
+            else self.configurations):
+            fprfx = overrides.get("file_prefix", self.file_prefix)
+            fext = overrides.get("file_ext", self.file_ext)
+            fext = ("."+fext) if (fext != "") else ""
+            other = seen.setdefault((fprfx, fext), name)
+            if other != name:
+                return (other, name, fprfx, fext)
+        return None
 
-    @property
-    def file_ext(self):
-        return self.state.get_var(2)
+# Attributes
+#     name (str)
+#     args (tuple)
+#     source (str)
+#     line (int)
+#     col (int)
+class HGenAction(object):
+    __name__='HGenAction'
+    __slots__=('name','args','source','line','col',)
+    def __init__(self, name: str, args: tuple,
+        source: str = "<script>", line: int = 0, col: int = 0) -> None:
+        self.name = name
+        self.args = args
+        self.source = source
+        self.line = line
+        self.col = col
+
+    def location(self) -> str:
+        return "{}:{}:{}".format(self.source, self.line, self.col)
 
-    @file_ext.setter
-    def file_ext(self,v: str):
-        self.state.set_var(2,v)
+    def __repr__(self):
+        return (
+            'HGenAction('
+            f'name={self.name!r}, '
+            f'args={self.args!r}, '
+            f'at={self.location()}'
+            ')'
+        )
 
-    @property
-    def license_notice(self):
-        return self.state.get_var(3)
+# Attributes
+#     written (int)
+#     unchanged (int)
+#     inputs (List[str]) - the script and every file it read
+#     input_stats (List[tuple]) - (path, size, mtime_ns) of the inputs,
+#         as they were right before being read
+#     outputs (List[str]) - every header path GENERATE_HEADERS produced
+#     license_hits (int)
+#     license_misses (int)
+#     profile (dict) - Profiler snapshot, only from batch workers
+#     unsynced (List[str]) - written under "batch" durability, not yet synced
+#     fingerprints (List[tuple]) - (path, size, mtime_ns, digest) of every
+#         header written or checked, for the BuildIndex
+#     up_to_date (bool) - skipped entirely, the BuildIndex said nothing changed
+class HGenRunStats(object):
+    __name__='HGenRunStats'
+    __slots__=('written','unchanged','inputs','input_stats','outputs',
+        'license_hits','license_misses','profile','unsynced','fingerprints',
+        'up_to_date',)
+    def __init__(self) -> None:
+        self.written: int = 0
+        self.unchanged: int = 0
+        self.inputs: List[str] = []
+        self.input_stats: List[tuple] = []
+        self.outputs: List[str] = []
+        self.license_hits: int = 0
+        self.license_misses: int = 0
+        self.profile: dict = None
+        self.unsynced: List[str] = []
+        self.fingerprints: List[tuple] = []
+        self.up_to_date: bool = False
+
+    def count(self, was_written: bool) -> None:
+        if was_written:
+            self.written += 1
+        else:
+            self.unchanged += 1
+
+    # call before reading path (st: its stat, if already taken), so that
+    # a file changing while it's being read never looks up to date to
+    # the BuildIndex later
+    def add_input(self, path: str, st: os.stat_result = None) -> None:
+        self.inputs.append(path)
+        if st == None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return # reading it is about to fail anyway
+        self.input_stats.append((path, st.st_size, st.st_mtime_ns))
+
+    def add(self, other: HGenRunStats) -> None:
+        self.written += other.written
+        self.unchanged += other.unchanged
+        self.inputs.extend(other.inputs)
+        self.outputs.extend(other.outputs)
+        self.license_hits += other.license_hits
+        self.license_misses += other.license_misses
+
+    def report(self) -> str:
+        ret = "{} header(s) written, {} unchanged".format(
+            self.written, self.unchanged
+        )
+        if self.up_to_date:
+            ret += " (up to date)"
+        if self.license_hits or self.license_misses:
+            ret += " (license cache: {} hit(s), {} miss(es))".format(
+                self.license_hits, self.license_misses
+            )
+        return ret
 
-    @license_notice.setter
-    def license_notice(self,v: str):
-        self.state.set_var(3,v)
+# Attributes
+#     state (HGenState) - the settings, as the actions so far left them
+#     stats (HGenRunStats) - of the script being run
+#     include_stack (List[str]) - the scripts being run, the innermost
+#         INCLUDE last
+#     current_action (HGenAction) - what do_action is running, for errors
+#         that need a location
+#     capture (list) - when a list, GENERATE_HEADERS adds its (bound
+#         template, (filepath, name) pairs, durability) to it instead
+#         of writing
+#     known_outputs (dict) - the headers' fingerprints from the last run
+#         (see BuildIndex), None when not tracking them
+#     plan_cache (bool) - whether INCLUDE'd scripts go through the
+#         on-disk PlanCache (see load_plan)
+#     jobs_override (int) - --jobs, wins over SET_JOBS in the script
+#     durability_override (str) - --durability, wins over SET_DURABILITY
+#     streaming (bool) - --stream, see stream_from_hgen_script
+#     shards (int) - --shards, worker processes for each GENERATE_HEADERS
+#         (see write_sharded_headers), 1 writes them from this process
+#     deferred_sync (bool) - leave what "batch" durability wrote in
+#         stats.unsynced for the caller, which syncs several scripts'
+#         headers at once (see run_scripts_results)
+# Everything a run of a script reads and changes. It's handed through
+# do_actions to every action handler, so scripts running at the same
+# time (one context each) never see each other's settings. The command
+# line options are set on default_context()
+class HGenContext(object):
+    __name__='HGenContext'
+    __slots__=('state','stats','include_stack','current_action','capture',
+        'known_outputs','plan_cache','jobs_override','durability_override',
+        'streaming','shards','deferred_sync',)
+    __options = ('jobs_override','durability_override','streaming','shards',)
+    def __init__(self, state: HGenState = None, *,
+        jobs_override: int = None, durability_override: str = None,
+        streaming: bool = False, shards: int = 1,
+        deferred_sync: bool = False) -> None:
+        self.state = state if state != None else HGenState()
+        self.stats = HGenRunStats()
+        self.include_stack: List[str] = []
+        self.current_action: HGenAction = None
+        self.capture: list = None
+        self.known_outputs: dict = None
+        self.plan_cache: bool = True
+        self.jobs_override = jobs_override
+        self.durability_override = durability_override
+        self.streaming = streaming
+        self.shards = shards
+        self.deferred_sync = deferred_sync
+
+    # the command line options by name, e.g. to put them back later
+    # with set_options()
+    def options(self) -> dict:
+        return {name: getattr(self, name) for name in self.__options}
+
+    def set_options(self, options: dict) -> None:
+        for name, value in options.items():
+            if name not in self.__options:
+                raise AttributeError(
+                    "HGenContext has no option {!r}".format(name))
+            setattr(self, name, value)
+
+_DEFAULT_CONTEXT: HGenContext = None
+
+# the context do_actions etc. use when they aren't given one
+def default_context() -> HGenContext:
+    global _DEFAULT_CONTEXT
+    if _DEFAULT_CONTEXT == None:
+        _DEFAULT_CONTEXT = HGenContext()
+    return _DEFAULT_CONTEXT
 
 class HGenBuiltIns(object):
     #__builtins
@@ -431,6 +1373,21 @@ class HGenSymbol(object):
 #    ScriptFile (str)
 class HGenEnvars(WEnum):
     DefaultScriptFilename: str = "HGenScript.hgen"
+    PlanCacheDirEnvar: str = "HGEN_CACHE_DIR"
+    PlanCacheMaxEntries: int = 64
+    WatchDebounceSeconds: float = 0.2
+    WatchPollSeconds: float = 0.5
+    ProfileMaxTraceEvents: int = 1000000
+    AsyncMaxWrites: int = 16
+    ScanThreads: int = 8
+    ShardSize: int = 4096
+    StreamChunkSize: int = 1 << 16
+    BuildIndexMaxEntries: int = 256
+    BuildIndexRacySeconds: float = 2.0
+    ServeSocketEnvar: str = "HGEN_SOCKET"
+    ServeIdleSeconds: float = 600.0
+    ServeMaxRequestBytes: int = 1 << 20
+    LogRingSize: int = 10000
 
 """
 
@@ -442,8 +1399,34 @@ class HeaderGenerator(SingletonBase):
     __available_builtin_actions: List[str] = [
         "SET_MACRO_PREFIX","SET_FILE_PREFIX",
         "SET_FILE_EXT","SET_LICENSE_NOTICE_SOURCE",
-        "GENERATE_HEADERS"
+        "SET_JOBS","SET_TEMPLATE_SOURCE","SET_DURABILITY",
+        "CONFIGURATION","INCLUDE","GENERATE_HEADERS","GENERATE_HEADERS_FROM"
     ]
+    # (min, max) argument count of each action, None means unbounded
+    __action_arity = {
+        "SET_MACRO_PREFIX":(0,1),
+        "SET_FILE_PREFIX":(0,1),
+        "SET_FILE_EXT":(0,1),
+        "SET_LICENSE_NOTICE_SOURCE":(0,1),
+        "SET_JOBS":(1,1),
+        "SET_TEMPLATE_SOURCE":(0,1),
+        "SET_DURABILITY":(1,1),
+        "CONFIGURATION":(1,None),
+        "INCLUDE":(1,1),
+        "GENERATE_HEADERS":(0,None),
+        "GENERATE_HEADERS_FROM":(1,None)
+    }
+    # actions whose handler takes its arguments as any iterable, so a
+    # streamed run can pass them on while they're still being parsed
+    __streamed_actions = ("GENERATE_HEADERS",)
+    # what CONFIGURATION(name, KEY=value) can set, KEY -> HGenState setting
+    __configuration_keys = {
+        "MACRO_PREFIX":"macro_prefix",
+        "FILE_PREFIX":"file_prefix",
+        "FILE_EXT":"file_ext",
+        "LICENSE_NOTICE_SOURCE":"license_notice",
+        "TEMPLATE_SOURCE":"template",
+    }
 
     def __SINGLETON_INIT__(self):
         self.ACTION_FUNC_TBL = {
@@ -451,41 +1434,223 @@ class HeaderGenerator(SingletonBase):
             "SET_FILE_PREFIX":self.SET_FILE_PREFIX,
             "SET_FILE_EXT":self.SET_FILE_EXT,
             "SET_LICENSE_NOTICE_SOURCE":self.SET_LICENSE_NOTICE_SOURCE,
-            "GENERATE_HEADERS":self.GENERATE_HEADERS
+            "SET_JOBS":self.SET_JOBS,
+            "SET_TEMPLATE_SOURCE":self.SET_TEMPLATE_SOURCE,
+            "SET_DURABILITY":self.SET_DURABILITY,
+            "CONFIGURATION":self.CONFIGURATION,
+            "INCLUDE":self.INCLUDE,
+            "GENERATE_HEADERS":self.GENERATE_HEADERS,
+            "GENERATE_HEADERS_FROM":self.GENERATE_HEADERS_FROM
         }
-    def execute_action_type(self,t: str, args: tuple) -> None:
+    # the handlers get the run's HGenContext, this holds no state of its own
+    def execute_action_type(self, ctx: HGenContext, t: str,
+        args: tuple) -> None:
         #self.__dict__[t](args)
-        self.ACTION_FUNC_TBL[t](args)
+        if Profiler.enabled:
+            with Profiler().phase("action:"+t):
+                self.ACTION_FUNC_TBL[t](ctx, args)
+            return
+        self.ACTION_FUNC_TBL[t](ctx, args)
 
-    def SET_MACRO_PREFIX(self,v) -> None:
-        HGenState().macro_prefix = v[0]
+    # SET_*() with no argument resets the setting to empty
+    def SET_MACRO_PREFIX(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("macro_prefix", v[0] if v else "")
 
-    def SET_FILE_PREFIX(self,v) -> None:
-        HGenState().file_prefix = v[0]
+    def SET_FILE_PREFIX(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("file_prefix", v[0] if v else "")
 
-    def SET_FILE_EXT(self, v) -> None:
-        HGenState().file_ext = v[0]
+    def SET_FILE_EXT(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("file_ext", v[0] if v else "")
 
-    def SET_LICENSE_NOTICE_SOURCE(self, v) -> None:
-        HGenState().license_notice = Sread_from(v[0])
+    def SET_LICENSE_NOTICE_SOURCE(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("license_notice", self.load_license(ctx, v[0]) if v else "")
 
-    def GENERATE_HEADERS(self, vtuple: tuple) -> None:#*args) -> None:
-        #files_to_gen: tuple = args # no "*" makes it pass as Tuple
-        genstate = HGenState()
+    def SET_JOBS(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("jobs", parse_jobs_value(v[0]))
+
+    def SET_TEMPLATE_SOURCE(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("template",
+            self.load_template(ctx, v[0]) if v else HeaderTemplate.default())
+
+    def SET_DURABILITY(self, ctx: HGenContext, v) -> None:
+        ctx.state.set("durability", parse_durability_value(v[0]))
+
+    def load_license(self, ctx: HGenContext, filepath: str) -> str:
+        ctx.stats.add_input(filepath)
+        text, hit = LicenseCache().load(filepath)
+        if hit:
+            ctx.stats.license_hits += 1
+        else:
+            ctx.stats.license_misses += 1
+        return text
+
+    def load_template(self, ctx: HGenContext, filepath: str) -> HeaderTemplate:
+        ctx.stats.add_input(filepath)
+        return HeaderTemplate.compile(Sread_from(filepath), filepath)
+
+    # CONFIGURATION(name, KEY=value, ...) adds a variant of the current
+    # settings, with KEY (MACRO_PREFIX, FILE_EXT, ...) set like SET_KEY
+    # would. once there are any, every GENERATE_HEADERS after them writes
+    # each header once per configuration, instead of with the settings
+    # themselves. their license notices and templates are loaded here
+    def CONFIGURATION(self, ctx: HGenContext, v) -> None:
+        act = ctx.current_action
+        where = act.location() if act != None else "<script>"
+        genstate = ctx.state
+        if any(name == v[0] for name, _ in genstate.configurations):
+            raise InvalidArgumentError(
+                "{}: configuration {} is already defined".format(where, v[0]))
+
+        overrides = {}
+        for arg in v[1:]:
+            key, eq, value = arg.partition("=")
+            setting = self.__configuration_keys.get(key)
+            if not eq or setting == None:
+                raise InvalidArgumentError(
+                    "{}: expected KEY=value with KEY one of {}, got {!r}".format(
+                        where, ", ".join(self.__configuration_keys), arg))
+            if setting == "license_notice" and value != "":
+                value = self.load_license(ctx, value)
+            elif setting == "template":
+                value = self.load_template(ctx, value) if value != "" else (
+                    HeaderTemplate.default()
+                )
+            overrides[setting] = value
+        configurations = genstate.configurations + ((v[0], overrides),)
+        clash = genstate.clashing_configurations(configurations)
+        if clash != None:
+            raise InvalidArgumentError(
+                "{}: configurations {} and {} would both write {}NAME{}, "
+                "give them different FILE_PREFIX or FILE_EXT values".format(
+                    where, *clash))
+        genstate.set("configurations", configurations)
+
+    # runs another script's actions right here, with the same settings.
+    # the path is relative to the including script
+    def INCLUDE(self, ctx: HGenContext, v) -> None:
+        act = ctx.current_action
+        where = act.location() if act != None else "<script>"
+        base = os.path.dirname(ctx.include_stack[-1]) if (
+            ctx.include_stack) else ""
+        path = os.path.normpath(os.path.join(base, v[0]))
+
+        key = os.path.abspath(path)
+        chain = [os.path.abspath(p) for p in ctx.include_stack]
+        if key in chain:
+            cycle = ctx.include_stack[chain.index(key):] + [path]
+            raise InvalidArgumentError("{}: INCLUDE cycle: {}".format(
+                where, " -> ".join(cycle)))
+        ctx.stats.add_input(path)
+        try:
+            actions = IncludeCache().load(path, ctx.plan_cache)
+        except OSError as err:
+            raise InvalidArgumentError("{}: cannot INCLUDE {}: {}".format(
+                where, path, err.strerror or err)) from None
+
+        ctx.include_stack.append(path)
+        try:
+            do_actions(actions, ctx)
+        finally:
+            ctx.include_stack.pop()
+            ctx.current_action = act
+
+    # the (filepath, name) of every header GENERATE_HEADERS(vtuple)
+    # makes with the current settings
+    def header_paths(self, ctx: HGenContext, vtuple):
+        genstate = ctx.state
         fprfx = genstate.file_prefix
         fext = ("."+genstate.file_ext) if (genstate.file_ext != "") else (
             ""
         )
-        for _f in vtuple:
-            Swrite_to(
-                fprfx+_f+fext,
-                generate_templated_header(_f)
+        return ((fprfx+_f+fext, _f) for _f in vtuple)
+
+    def GENERATE_HEADERS(self, ctx: HGenContext, vtuple: tuple) -> None:#*args) -> None:
+        #files_to_gen: tuple = args # no "*" makes it pass as Tuple
+        self.generate_headers(ctx, vtuple)
+
+    # GENERATE_HEADERS for the name (stem) of every file below a directory
+    # whose name matches one of the patterns (any file without patterns)
+    def GENERATE_HEADERS_FROM(self, ctx: HGenContext, v) -> None:
+        act = ctx.current_action
+        root = v[0]
+        if not os.path.isdir(root):
+            raise InvalidArgumentError("{}: {} is not a directory".format(
+                act.location() if act != None else "<script>", root))
+        ctx.stats.add_input(root)
+        # every directory scanned is an input, a file added anywhere
+        # below root changes one of their mtimes
+        self.generate_headers(ctx, scan_header_names(root, v[1:],
+            on_dir=ctx.stats.add_input))
+
+    # names may be any iterable, it's consumed as the headers are written
+    def generate_headers(self, ctx: HGenContext, names) -> None:
+        genstate = ctx.state
+        jobs = ctx.jobs_override if (ctx.jobs_override != None) else (
+            genstate.jobs
+        )
+        durability = ctx.durability_override if (
+            ctx.durability_override != None) else genstate.durability
+        # everything but the header name is filled in once per call
+        if genstate.configurations:
+            # a SET_* since the CONFIGURATIONs may have made two of them
+            # write the same paths
+            clash = genstate.clashing_configurations()
+            if clash != None:
+                act = ctx.current_action
+                raise InvalidArgumentError(
+                    "{}: configurations {} and {} would both write "
+                    "{}NAME{}".format(
+                        act.location() if act != None else "<script>",
+                        *clash))
+            # every configuration's header for a name, before the next name
+            variants = genstate.variants()
+            bound = tuple(v[0] for v in variants)
+            work = ((fprfx+_f+fext, _f, k) for _f in names
+                for k, (_, fprfx, fext) in enumerate(variants))
+        else:
+            bound = genstate.bound_template()
+            work = self.header_paths(ctx, names)
+
+        outputs = ctx.stats.outputs
+        def record(work):
+            for item in work:
+                outputs.append(item[0])
+                yield item
+        if not ctx.streaming: # which would keep every path in memory
+            work = record(work)
+        if ctx.capture != None: # plan_outputs, nothing is written
+            work = list(work)
+            if type(bound) is tuple: # one batch per configuration
+                for k, b in enumerate(bound):
+                    ctx.capture.append((b,
+                        [(path, name) for path, name, i in work if i == k],
+                        durability))
+            else:
+                ctx.capture.append((bound, work, durability))
+            return
+        if ctx.shards > 1:
+            failures = write_sharded_headers(work, ctx.shards, ctx.stats,
+                bound, durability, jobs, ctx.known_outputs, ctx.state)
+        else:
+            failures = write_templated_headers(
+                work, jobs, ctx.stats, bound, durability, ctx.known_outputs
             )
+        if failures:
+            for path, err in failures:
+                print("ERROR: could not generate {}: {}".format(path, err),
+                    file=sys.stderr)
+            raise HeaderWriteError(failures)
 
     @property
     def builtin_actions(self):
         return self.__available_builtin_actions
 
+    def arity_of(self, t: str) -> Tuple[int, int]:
+        return self.__action_arity[t]
+
+    def is_streamed(self, t: str) -> bool:
+        return t in self.__streamed_actions
+
 # create a hgen script based on a template...
 def create_templated_hgen_script(xfile: str) -> None:
     TEMPLATE = """
@@ -508,114 +1673,1682 @@ GENERATE_HEADERS(
     """
     Swrite_to(xfile, TEMPLATE)
 
-def isolate_arguments(act: str) -> str or None:
+def parse_jobs_value(v: str, what: str = "jobs") -> int:
+    try:
+        jobs = int(v)
+    except (TypeError, ValueError):
+        jobs = 0
+    if jobs < 1:
+        raise InvalidArgumentError(
+            "{} must be a positive integer, got {!r}".format(what, v)
+        )
+    return jobs
+
+# returns whether the header had to be (re)written
+def write_templated_header(filepath: str, xfile: str,
+    bound: BoundTemplate = None, durability: str = "none") -> bool:
+    return Swrite_if_changed(filepath, generate_templated_header(xfile, bound),
+        durability)
+
+# write_templated_header through Swrite_tracked, returning
+# (whether it was written, its fingerprint)
+def write_tracked_header(filepath: str, xfile: str,
+    bound: BoundTemplate = None, durability: str = "none",
+    known: dict = None) -> Tuple[bool, tuple]:
+    return Swrite_tracked(filepath, generate_templated_header(xfile, bound),
+        durability, known.get(filepath) if known != None else None)
+
+# renders and writes every (filepath, name) pair, either serially or
+# through a bounded thread pool, and returns the failures in input order
+# instead of stopping at the first one. with a tuple of bound templates
+# (a CONFIGURATION matrix) the work is (filepath, name, index into it)
+# triples instead. under "batch" durability the written paths are left
+# in stats.unsynced for sync_outputs. with `known` (filepath ->
+# fingerprint from the last run, see BuildIndex) the headers'
+# fingerprints are collected in stats.fingerprints
+def write_templated_headers(work, jobs: int = 1,
+    stats: HGenRunStats = None,
+    bound: BoundTemplate or tuple = None,
+    durability: str = "none",
+    known: dict = None) -> List[Tuple[str, Exception]]:
+    failures: List[Tuple[int, str, Exception]] = []
+    if stats == None:
+        stats = HGenRunStats()
+    batch = (durability == "batch")
+    if known != None:
+        write = write_tracked_header
+        args = (durability, known)
+    else:
+        write = write_templated_header
+        args = (durability,)
+    if type(bound) is tuple:
+        bounds = bound
+        write_with = write
+        def write(path: str, xfile: str, variant: int, *rest):
+            return write_with(path, xfile, bounds[variant], *rest)
+    else:
+        args = (bound,) + args
+
+    def record(path: str, result) -> None:
+        if known != None:
+            written, fp = result
+            stats.fingerprints.append((path,) + fp)
+        else:
+            written = result
+        stats.count(written)
+        if written and batch:
+            stats.unsynced.append(path)
+
+    if jobs <= 1:
+        for index,item in enumerate(work,start=0):
+            path = item[0]
+            try:
+                result = write(*item, *args)
+            except Exception as err:
+                failures.append((index, path, err))
+                continue
+            record(path, result)
+        return [(path, err) for _, path, err in failures]
+
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    def collect(done) -> None:
+        for fut in done:
+            index, path = pending.pop(fut)
+            err = fut.exception()
+            if err != None:
+                failures.append((index, path, err))
+            else: # results are only ever counted on this thread
+                record(path, fut.result())
+
+    # keep only a few batches in flight so huge name lists
+    # don't turn into an equally huge list of futures
+    max_pending = jobs * 4
+    pending = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for index,item in enumerate(work,start=0):
+            if len(pending) >= max_pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+            pending[pool.submit(write, *item, *args)] = (index, item[0])
+        collect(wait(pending)[0])
+
+    failures.sort(key=lambda f: f[0])
+    return [(path, err) for _, path, err in failures]
+
+# write_templated_headers across `shards` worker processes, for when a
+# single GENERATE_HEADERS lists far more headers than one core can keep
+# up with. the (filepath, name) pairs are cut into consecutive shards of
+# ShardSize, each written by whichever worker is free, and every worker
+# is handed `state` (default_context()'s by default) just once, when it
+# starts. a work list that fits in one shard is written right here. the
+# shards' stats are added to `stats`, and the failures are returned in
+# input order
+def write_sharded_headers(work, shards: int,
+    stats: HGenRunStats = None,
+    bound: BoundTemplate or tuple = None,
+    durability: str = "none",
+    jobs: int = 1,
+    known: dict = None,
+    state: HGenState = None) -> List[Tuple[str, Exception]]:
+    import itertools
+    if stats == None:
+        stats = HGenRunStats()
+    size = HGenEnvars.get("ShardSize")
+    work = iter(work)
+    batches = iter(lambda: list(itertools.islice(work, size)), [])
+    first = next(batches, [])
+    if len(first) < size:
+        return write_templated_headers(first, jobs, stats, bound,
+            durability, known)
+
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    failures: List[Tuple[int, str, Exception]] = []
+    if state == None:
+        state = default_context().state
+
+    def collect(done) -> None:
+        for fut in done:
+            index = pending.pop(fut)
+            shard, shard_failures = fut.result()
+            if (__debug__):
+                Logger().print("write_sharded_headers","Shard {}: {}",
+                    index,shard.report())
+            stats.written += shard.written
+            stats.unchanged += shard.unchanged
+            stats.unsynced.extend(shard.unsynced)
+            stats.fingerprints.extend(shard.fingerprints)
+            failures.extend((index, path, err) for path, err in shard_failures)
+
+    # like write_templated_headers, only a few shards are in flight at once
+    pending = {}
+    with ProcessPoolExecutor(max_workers=shards,
+        initializer=init_header_shard,
+        initargs=(state.settings(), durability, jobs)) as pool:
+        for index, batch in enumerate(itertools.chain([first], batches)):
+            if len(pending) >= shards * 2:
+                collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+            pending[pool.submit(write_header_shard, batch, {
+                item[0]: known[item[0]] for item in batch if item[0] in known
+            } if known != None else None)] = index
+        collect(wait(pending)[0])
+
+    failures.sort(key=lambda f: f[0]) # stable, so in order within a shard
+    return [(path, err) for _, path, err in failures]
+
+# what init_header_shard set up in a write_sharded_headers worker:
+# (bound template(s), durability, jobs)
+_SHARD_SETTINGS: tuple = None
+
+def init_header_shard(settings: dict, durability: str, jobs: int) -> None:
+    global _SHARD_SETTINGS
+    genstate = HGenState()
+    genstate.update(settings)
+    _SHARD_SETTINGS = (tuple(v[0] for v in genstate.variants())
+        if genstate.configurations else genstate.bound_template(),
+        durability, jobs)
+
+# writes one shard in a worker, returning its (stats, failures)
+def write_header_shard(work: list,
+    known: dict = None) -> Tuple[HGenRunStats, List[Tuple[str, Exception]]]:
+    bound, durability, jobs = _SHARD_SETTINGS
+    stats = HGenRunStats()
+    failures = write_templated_headers(work, jobs, stats, bound,
+        durability, known)
+    return (stats, failures)
+
+# the header names for GENERATE_HEADERS_FROM, streamed as the tree below
+# root is walked: the stems of the files matching any of the (fnmatch)
+# patterns, each only once (a warning names the file a stem came from
+# when another file has it too). directories are scanned in parallel, each
+# one's names in sorted order; hidden directories and symlinked ones
+# are skipped. on_dir(path, stat) is called for every subdirectory
+# scanned, with its stat from right before it was listed
+def scan_header_names(root: str, patterns: tuple = (),
+    threads: int = None, on_dir = None):
+    import fnmatch
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    if threads == None:
+        threads = HGenEnvars.get("ScanThreads")
+
+    # names are (stem, path) pairs
+    def scan(d: str) -> Tuple[List[tuple], List[str], os.stat_result]:
+        names: List[tuple] = []
+        subdirs: List[str] = []
+        st = None
+        try:
+            st = os.stat(d)
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if not e.name.startswith("."):
+                                subdirs.append(e.path)
+                        # fnmatch ignores case where the file system does
+                        elif e.is_file() and (not patterns or
+                            any(fnmatch.fnmatch(e.name, p) for p in patterns)):
+                            names.append(
+                                (os.path.splitext(e.name)[0], e.path))
+                    except OSError:
+                        continue
+        except OSError as err:
+            if d == root:
+                raise
+            Logger().print("scan_header_names","Skipping {}: {}",d,err,
+                level=LogLevel.get("WARNING"))
+        names.sort()
+        return (names, subdirs, st)
+
+    seen = {} # stem -> path it came from
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = {pool.submit(scan, root): root} # future -> directory
+        while pending:
+            for fut in wait(pending, return_when=FIRST_COMPLETED)[0]:
+                d = pending.pop(fut)
+                names, subdirs, st = fut.result()
+                if on_dir != None and d != root and st != None:
+                    on_dir(d, st)
+                for sub in subdirs:
+                    pending[pool.submit(scan, sub)] = sub
+                for name, path in names:
+                    first = seen.setdefault(name, path)
+                    if first is path:
+                        yield name
+                    else:
+                        Logger().print("scan_header_names",
+                            "{} and {} both give header {}, using {}",
+                            first,path,name,first,
+                            level=LogLevel.get("WARNING"))
+
+# ctx defaults to default_context(), here and below
+def do_action(act: HGenAction, ctx: HGenContext = None) -> None:
+    ASSERT_TUPLE(act.args)
+    if ctx == None:
+        ctx = default_context()
+    ctx.current_action = act
+    HeaderGenerator().execute_action_type(ctx, act.name, act.args)
+
+def do_actions(actions: List[HGenAction], ctx: HGenContext = None) -> None:
+    if ctx == None:
+        ctx = default_context()
+    for x in actions:
+        do_action(x, ctx)
+
+# renders the header for xfile, with the context's template
+# unless an already bound one is passed in
+@profiled("generate_templated_header")
+def generate_templated_header(xfile: str, bound: BoundTemplate = None,
+    ctx: HGenContext = None) -> str:
+    if bound == None:
+        bound = (ctx if ctx != None else default_context()
+            ).state.bound_template()
+    return bound.render(xfile)
+
+
+# run the hgen from this script file... starting from the context's
+# settings. scripts may run at the same time in threads, each with
+# its own context
+@profiled("run_from_hgen_script")
+def run_from_hgen_script(xfile: str, ctx: HGenContext = None) -> HGenRunStats:
+    if ctx == None:
+        ctx = default_context()
+    if ctx.streaming:
+        return stream_from_hgen_script(xfile, ctx)
+    stats = ctx.stats = HGenRunStats()
+    ctx.include_stack = [xfile]
+
+    # keyed on the settings the script starts from, before it changes them
+    index = BuildIndex()
+    key = index.key_for(xfile, ctx.state)
+    record = index.load(key, xfile)
+    if record != None and index.is_up_to_date(record):
+        return index.stats_from(record)
+    ctx.known_outputs = index.known_outputs(record) if index.enabled() else None
+
+    stats.add_input(xfile)
+    actions = load_plan(Sread_from(xfile), xfile)
+    try:
+        do_actions(actions, ctx)
+    finally: # whatever got written is synced, even if a later action failed
+        if not ctx.deferred_sync:
+            sync_outputs(stats.unsynced)
+            stats.unsynced = []
+        ctx.known_outputs = None
+    index.store(key, xfile, stats)
+    return stats
+
+# run_from_hgen_script for scripts too big to hold in memory (--stream):
+# the script is read in chunks and each action runs as soon as it has
+# been parsed, GENERATE_HEADERS writing every header as its name comes
+# in. the script is only validated as it goes, so an error halfway
+# through leaves the headers before it written. neither the PlanCache
+# nor the BuildIndex are used, and stats.outputs stays empty
+@profiled("stream_from_hgen_script")
+def stream_from_hgen_script(xfile: str,
+    ctx: HGenContext = None) -> HGenRunStats:
+    if ctx == None:
+        ctx = default_context()
+    hgen = HeaderGenerator()
+    stats = ctx.stats = HGenRunStats()
+    ctx.include_stack = [xfile]
+
+    stats.add_input(xfile)
+    try:
+        for act in iter_stream_actions(Sread_chunks(xfile), xfile):
+            ctx.current_action = act
+            hgen.execute_action_type(ctx, act.name, act.args)
+    finally:
+        if not ctx.deferred_sync:
+            sync_outputs(stats.unsynced)
+            stats.unsynced = []
+    return stats
+
+# the validated actions of a script, from the PlanCache when possible
+# (and use_cache allows it)
+def load_plan(scriptD: str, xfile: str,
+    use_cache: bool = True) -> List[HGenAction]:
+    if not use_cache:
+        actions = parse_script(scriptD, xfile)
+        are_actions_valid(actions)
+        return actions
+    cache = PlanCache()
+    key: str = cache.key_for(scriptD)
+    actions: List[HGenAction] = cache.load(key, xfile)
+    if actions == None:
+        actions = parse_script(scriptD, xfile)
+        are_actions_valid(actions)
+        cache.store(key, actions)
+    return actions
+
+@profiled("parse_script")
+def parse_script(d: str, source: str = "<script>") -> List[HGenAction]:
+    return list(iter_actions(d, source))
+
+_SCRIPT_PATTERNS: tuple = None
+
+# the parser's regexes, compiled on first use so that commands which
+# never parse a script don't import `re`
+def script_patterns() -> tuple:
+    global _SCRIPT_PATTERNS
+    if _SCRIPT_PATTERNS == None:
+        import re
+        # whitespace and comments between tokens. a comment always runs
+        # to the end of its line, which keeps the repetition from ever
+        # backtracking
+        skip = r'(?:\s|#[^\n]*(?![^\n]))*'
+        _SCRIPT_PATTERNS = (
+            re.compile(skip),
+            # `NAME(`
+            re.compile(skip + r'([A-Za-z_][A-Za-z0-9_]*)' + skip + r'\('),
+            # `)` straight after `NAME(`
+            re.compile(skip + r'\)'),
+            # one argument together with the `,` or `)` that follows it
+            re.compile(skip + r'([^\s(),#]+)' + skip + r'([,)])'),
+            # a single token, only used to describe syntax errors
+            re.compile(r'[(),]|[^\s(),#]+'),
+            re.compile(r'[A-Za-z_][A-Za-z0-9_]*'),
+        )
+    return _SCRIPT_PATTERNS
+
+# streams through the script once, yielding an HGenAction for every
+# `NAME(arg, arg, ...)` and raising HGenSyntaxError (with line and
+# column) on anything else. whitespace and newlines only separate tokens
+def iter_actions(d: str, source: str = "<script>"):
+    _SKIP_PAT, _HEAD_PAT, _EMPTY_PAT, _ARG_PAT, _TOKEN_PAT, \
+        _ACTION_NAME_PAT = script_patterns()
+
+    # line/column are only worked out for the (few) positions that
+    # need them, always moving forward through the script
+    line = 1
+    line_start = 0
+    last = 0
+    def where(pos: int) -> Tuple[int, int]:
+        nonlocal line, line_start, last
+        nl = d.count("\n", last, pos)
+        if nl:
+            line += nl
+            line_start = d.rindex("\n", last, pos) + 1
+        last = pos
+        return (line, pos - line_start + 1)
+
+    # (position, text) of the next token from pos on, text is "" at the end
+    def next_token(pos: int) -> Tuple[int, str]:
+        pos = _SKIP_PAT.match(d, pos).end()
+        mo = _TOKEN_PAT.match(d, pos)
+        return (pos, mo.group() if mo else "")
+
+    def fail(message: str, pos: int, tok: str):
+        if tok == "":
+            return HGenSyntaxError(
+                "unterminated {}(...) at end of script".format(name),
+                source, *name_at)
+        return HGenSyntaxError(
+            "{}, found {!r}".format(message, tok), source, *where(pos))
+
+    pos = 0
+    end = len(d)
+    name: str = ""
+    name_at: Tuple[int, int] = (0, 0)
+    while True:
+        mo = _HEAD_PAT.match(d, pos)
+        if mo == None:
+            at, tok = next_token(pos)
+            if at == end:
+                return
+            if _ACTION_NAME_PAT.fullmatch(tok):
+                name = tok
+                name_at = where(at)
+                at, tok = next_token(at + len(tok))
+                if tok == "":
+                    raise HGenSyntaxError(
+                        "expected '(' after {} at end of script".format(name),
+                        source, *name_at)
+                raise fail("expected '(' after {}".format(name), at, tok)
+            raise fail("expected an action name", at, tok)
+
+        name = mo.group(1)
+        name_at = where(mo.start(1))
+        pos = mo.end()
+
+        mo = _EMPTY_PAT.match(d, pos)
+        if mo != None:
+            pos = mo.end()
+            yield HGenAction(name, (), source, *name_at)
+            continue
+
+        args: List[str] = []
+        while True:
+            mo = _ARG_PAT.match(d, pos)
+            if mo == None:
+                at, tok = next_token(pos)
+                if tok in ("", "(", ",", ")"):
+                    raise fail(
+                        "expected an argument to {}".format(name), at, tok)
+                at, tok = next_token(at + len(tok))
+                raise fail(
+                    "expected ',' or ')' in {}(...)".format(name), at, tok)
+            args.append(mo.group(1))
+            pos = mo.end()
+            if mo.group(2) == ")":
+                break
+        yield HGenAction(name, tuple(args), source, *name_at)
+
+# (token, line, column) of every `(`, `)`, `,` and argument in the
+# script, read from an iterable of text chunks. a token that may go on
+# in the next chunk is held back until it arrives
+def iter_script_tokens(chunks):
+    import re
+    pat = re.compile(r'\s+|#[^\n]*|[(),]|[^\s(),#]+')
+
+    line = 1
+    line_start = 0 # where the line starts, counted from the script's start
+    base = 0 # and where buf does
+    buf = ""
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk == None:
+            final = True
+        else:
+            buf += chunk
+        done = 0
+        for mo in pat.finditer(buf):
+            if not final and mo.end() == len(buf):
+                break
+            done = mo.end()
+            tok = mo.group()
+            if tok[0] == "#":
+                continue
+            if tok[0].isspace():
+                nl = tok.count("\n")
+                if nl:
+                    line += nl
+                    line_start = base + mo.start() + tok.rindex("\n") + 1
+                continue
+            yield (tok, line, base + mo.start() - line_start + 1)
+        base += done
+        buf = buf[done:]
+
+# iter_actions over chunks of the script (see iter_script_tokens), each
+# action validated before it's yielded. the arguments of streamed actions
+# (see HeaderGenerator.is_streamed) are a generator that parses them as
+# they're consumed, instead of a tuple; the next action is only parsed
+# once they all were. raises the same errors as iter_actions
+def iter_stream_actions(chunks, source: str = "<script>"):
+    _ACTION_NAME_PAT = script_patterns()[5]
+    hgen = HeaderGenerator()
+    tokens = iter_script_tokens(chunks)
+    end = ("", 0, 0)
+
+    def fail(message: str, name: str, name_at: Tuple[int, int],
+        tok: str, line: int, col: int):
+        if tok == "":
+            return HGenSyntaxError(
+                "unterminated {}(...) at end of script".format(name),
+                source, *name_at)
+        return HGenSyntaxError(
+            "{}, found {!r}".format(message, tok), source, line, col)
+
+    # like _ARG_PAT, an argument is only taken together with the `,`
+    # or `)` that follows it
+    def arguments(name: str, name_at: Tuple[int, int]):
+        tok, line, col = next(tokens, end)
+        if tok == ")":
+            return
+        while True:
+            if tok in ("", "(", ",", ")"):
+                raise fail("expected an argument to {}".format(name),
+                    name, name_at, tok, line, col)
+            arg = tok
+            tok, line, col = next(tokens, end)
+            if tok not in (",", ")"):
+                raise fail("expected ',' or ')' in {}(...)".format(name),
+                    name, name_at, tok, line, col)
+            yield arg
+            if tok == ")":
+                return
+            tok, line, col = next(tokens, end)
+
+    for tok, line, col in tokens:
+        if not _ACTION_NAME_PAT.fullmatch(tok):
+            raise HGenSyntaxError("expected an action name, found {!r}".format(
+                tok), source, line, col)
+        name = tok
+        name_at = (line, col)
+        tok, line, col = next(tokens, end)
+        if tok == "":
+            raise HGenSyntaxError(
+                "expected '(' after {} at end of script".format(name),
+                source, *name_at)
+        if tok != "(":
+            raise HGenSyntaxError("expected '(' after {}, found {!r}".format(
+                name, tok), source, line, col)
+
+        args = arguments(name, name_at)
+        if not hgen.is_streamed(name):
+            args = tuple(args)
+        act = HGenAction(name, args, source, *name_at)
+        if isinstance(args, tuple):
+            is_valid_action(act)
+            yield act
+        else: # a built-in taking any number of arguments
+            yield act
+            for _ in args: # whatever the action left unparsed
+                pass
+
+@profiled("are_actions_valid")
+def are_actions_valid(actions: List[HGenAction]) -> bool:
+    for x in actions:
+        if not is_valid_action(x):return False
+    return True
+
+def is_valid_action(action: HGenAction) -> bool:
+    hgen = HeaderGenerator()
+    a = action.name
+    if not (a in hgen.builtin_actions):
+        raise InvalidActionError("{}: {} is not a valid Action!".format(
+            action.location(), a))
+
+    least, most = hgen.arity_of(a)
+    count = len(action.args)
+    if count < least or (most != None and count > most):
+        raise InvalidArgumentError(
+            "{}: {} takes {} argument(s), got {}".format(
+                action.location(), a,
+                least if least == most else (
+                    "at least {}".format(least) if most == None else
+                    "{} to {}".format(least, most)
+                ),
+                count
+            )
+        )
+    return True
+
+
+"""
+
+Library API
+
+"""
+
+# runs the actions from the given settings (the defaults, updated with
+# `state`), with GENERATE_HEADERS (INCLUDE'd ones too) writing nothing.
+# returns each GENERATE_HEADERS' bound template, (filepath, name) pairs
+# and durability. the files read are added to stats.inputs, the outputs
+# to stats.outputs. INCLUDE paths are relative to `xfile`, when the
+# actions come from one, and INCLUDE'd scripts only go through the
+# on-disk PlanCache with `plan_cache`. every call runs in a context of
+# its own
+def plan_outputs(actions: List[HGenAction], state: dict = None,
+    stats: HGenRunStats = None, xfile: str = None,
+    plan_cache: bool = True) -> List[Tuple[
+    BoundTemplate, List[Tuple[str, str]], str]]:
+    ctx = HGenContext()
+    ctx.plan_cache = plan_cache
+    if state != None:
+        ctx.state.update(state)
+    if stats != None:
+        ctx.stats = stats
+    ctx.include_stack = [xfile] if xfile != None else []
+    ctx.capture = batches = []
+    do_actions(actions, ctx)
+    return batches
+
+# the (filepath, text) of every header script_text generates, rendered
+# one at a time as they are asked for. nothing is written, not even to
+# the PlanCache; license notices and templates named by the script are
+# still read, relative to the working directory. INCLUDE paths are
+# relative to `source` when it names a file, like they would be for a
+# --run of it, and to the working directory otherwise. the script is
+# parsed, validated and its settings applied right away, so errors are
+# raised here rather than on the first next()
+def iter_generate(script_text: str, *, state: dict = None,
+    source: str = "<script>"):
+    ASSERT_STR(script_text)
+    actions = parse_script(script_text, source)
+    are_actions_valid(actions)
+    batches = plan_outputs(actions, state,
+        xfile=source if os.path.isfile(source) else None, plan_cache=False)
+
+    def render():
+        for bound, work, _ in batches:
+            for path, xfile in work:
+                yield (path, generate_templated_header(xfile, bound))
+    return render()
+
+# like iter_generate, but everything at once: filepath -> text, in the
+# order the script generates them (a path generated twice keeps the
+# last text, as it would on disk)
+def generate(script_text: str, *, state: dict = None,
+    source: str = "<script>") -> dict:
+    return dict(iter_generate(script_text, state=state, source=source))
+
+# runs the script at xfile from an asyncio event loop, like --run would
+# but without blocking it: reading, parsing, license/template loading
+# and every write happen on `executor` (the loop's default one unless
+# given), at most `max_writes` writes at a time. each call gets its own
+# settings (the defaults, updated with `state`), so scripts may run
+# concurrently in one loop. `durability` overrides SET_DURABILITY.
+# raises HeaderWriteError once every header was tried, if any failed
+async def run_script_async(xfile: str, *, state: dict = None,
+    max_writes: int = None, durability: str = None,
+    executor = None) -> HGenRunStats:
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if max_writes == None:
+        max_writes = HGenEnvars.get("AsyncMaxWrites")
+    if max_writes < 1:
+        raise InvalidArgumentError(
+            "max_writes must be a positive integer, got {!r}".format(max_writes))
+    if durability != None:
+        parse_durability_value(durability)
+
+    stats = HGenRunStats()
+    stats.add_input(xfile)
+    scriptD = await loop.run_in_executor(executor, Sread_from, xfile)
+    actions = await loop.run_in_executor(executor, load_plan, scriptD, xfile)
+    batches = await loop.run_in_executor(executor, plan_outputs,
+        actions, state, stats, xfile)
+
+    # each of the max_writes workers takes the next header until there are
+    # none left, rather than one task per header
+    def work_items():
+        index = 0
+        for bound, work, script_durability in batches:
+            d = durability if durability != None else script_durability
+            for path, name in work:
+                yield (index, path, name, bound, d)
+                index += 1
+    items = work_items()
+    failures: List[Tuple[int, str, Exception]] = []
+
+    async def writer() -> None:
+        for index, path, name, bound, d in items:
+            try:
+                written = await loop.run_in_executor(executor,
+                    write_templated_header, path, name, bound, d)
+            except Exception as err:
+                failures.append((index, path, err))
+                continue
+            stats.count(written)
+            if written and d == "batch":
+                stats.unsynced.append(path)
+
+    try:
+        await asyncio.gather(*(writer() for _ in range(max_writes)))
+    finally:
+        if stats.unsynced:
+            await loop.run_in_executor(executor, sync_outputs, stats.unsynced)
+            stats.unsynced = []
+    if failures:
+        failures.sort(key=lambda f: f[0])
+        raise HeaderWriteError([(path, err) for _, path, err in failures])
+    return stats
+
+
+"""
+
+Parsed action plan cache
+
+"""
+
+_CODE_VERSION: str = None
+
+# the code that is running, for the PlanCache and BuildIndex keys: what
+# they keep is only right for the code that made it, and __version__
+# isn't bumped for every change. a digest of this file, or the stat of
+# the executable in frozen builds (hashing all of that on every run
+# would cost more than the caches save)
+def code_version() -> str:
+    global _CODE_VERSION
+    if _CODE_VERSION == None:
+        try:
+            if getattr(sys, "frozen", False):
+                st = os.stat(sys.executable)
+                _CODE_VERSION = "{}:{}:{}".format(
+                    sys.executable, st.st_size, st.st_mtime_ns)
+            else:
+                with io.open(os.path.abspath(__file__), "rb") as f:
+                    _CODE_VERSION = Sdigest(f.read()).hex()
+        except OSError: # __version__ alone, then
+            _CODE_VERSION = ""
+    return _CODE_VERSION
+
+# Validated action plans, kept on disk between runs so an unchanged
+# script goes straight to do_actions. Entries are keyed by a hash of the
+# script text and the running code (see code_version), hold nothing but
+# str/int tuples (marshal), and the least recently used ones are dropped
+# once there are more than PlanCacheMaxEntries of them.
+class PlanCache(SingletonBase):
+    __MAGIC = b"HGENC1\n"
+    # bump whenever what gets stored for a plan changes shape
+    __FORMAT = 1
+
+    def __SINGLETON_INIT__(self):
+        self.enabled: bool = True
+        self.max_entries: int = HGenEnvars.get("PlanCacheMaxEntries")
+        # key -> plan, in front of the disk. only long running
+        # processes (--serve) keep one, see keep_in_memory()
+        self.memory: dict = None
+        self.directory: str = os.environ.get(
+            HGenEnvars.get("PlanCacheDirEnvar")) or self.default_directory()
+
+    @staticmethod
+    def default_directory() -> str:
+        base = os.environ.get("LOCALAPPDATA") or os.environ.get(
+            "XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "headergen")
+
+    def key_for(self, script: str) -> str:
+        import hashlib
+        import marshal
+        h = hashlib.sha256()
+        h.update(repr((
+            __version__, self.__FORMAT, marshal.version, sys.version_info[:2],
+            code_version()
+        )).encode("utf-8"))
+        h.update(b"\0")
+        h.update(script.encode("utf-8", "surrogatepass"))
+        return h.hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".hgenc")
+
+    def keep_in_memory(self) -> None:
+        if self.memory == None:
+            self.memory = {}
+
+    # dicts keep insertion order, so the first key is the least recent
+    def remember(self, key: str, plan: tuple) -> None:
+        if self.memory == None:
+            return
+        self.memory.pop(key, None)
+        self.memory[key] = plan
+        while len(self.memory) > self.max_entries:
+            del self.memory[next(iter(self.memory))]
+
+    @staticmethod
+    def actions_from(plan: tuple, source: str) -> List[HGenAction]:
+        return [
+            HGenAction(name, args, source, line, col)
+            for name, args, line, col in plan
+        ]
+
+    # the cached plan for key, with locations pointing at source,
+    # or None on a miss. a broken entry is just a miss
+    @profiled("PlanCache.load")
+    def load(self, key: str, source: str) -> List[HGenAction] or None:
+        if not self.enabled:
+            return None
+        if self.memory != None and key in self.memory:
+            plan = self.memory[key]
+            self.remember(key, plan)
+            if (__debug__):
+                Logger().print("PlanCache.load","Memory hit for {}",source)
+            return self.actions_from(plan, source)
+
+        import marshal
+        path = self.path_for(key)
+        try:
+            f = io.open(path, "rb")
+            try:
+                dat = f.read()
+            finally:
+                f.close()
+            if not dat.startswith(self.__MAGIC):
+                raise ValueError("bad magic")
+            stored_key, plan = marshal.loads(dat[len(self.__MAGIC):])
+            if stored_key != key:
+                raise ValueError("key mismatch")
+            actions = self.actions_from(plan, source)
+        except FileNotFoundError:
+            Logger().print("PlanCache.load","Miss for {}",source)
+            return None
+        except (OSError, ValueError, EOFError, TypeError) as err:
+            Logger().print("PlanCache.load",
+                "Ignoring unusable entry {}: {}",path,err,
+                level=LogLevel.get("WARNING"))
+            return None
+
+        try: # mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        Logger().print("PlanCache.load","Hit for {}",source)
+        self.remember(key, plan)
+        return actions
+
+    @profiled("PlanCache.store")
+    def store(self, key: str, actions: List[HGenAction]) -> None:
+        if not self.enabled:
+            return
+        import marshal
+        plan = tuple(
+            (act.name, act.args, act.line, act.col) for act in actions
+        )
+        self.remember(key, plan)
+        dat = self.__MAGIC + marshal.dumps((key, plan))
+        path = self.path_for(key)
+        import threading # run_script_async may store from several threads
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            f = io.open(tmp, "wb")
+            try:
+                f.write(dat)
+            finally:
+                f.close()
+            # readers only ever see a complete entry
+            os.replace(tmp, path)
+        except OSError as err:
+            Logger().print("PlanCache.store",
+                "Could not cache plan in {}: {}",path,err,
+                level=LogLevel.get("WARNING"))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.prune()
+
+    def prune(self) -> None:
+        prune_cache_files(self.directory, ".hgenc", self.max_entries)
+
+# drops all but the max_entries most recently used (mtime)
+# files ending in suffix from directory
+def prune_cache_files(directory: str, suffix: str, max_entries: int) -> None:
     try:
-        return act.split("(")[1][0:-1]
-    except IndexError:
-        return ""
-    except:
-        pass
-
-def isolate_action(act: str) -> str:
-    return act.split("(")[0]
-
-def separate_arguments(args: str) -> List[str]:
-    return args.split(",")
-
-def remove_spaces(tmpL: List[str]):
-    for i in range(len(tmpL)):
-        tmpL[i] = tmpL[i].replace(" ","")
-    return tmpL
-
-def do_action(act: str) -> None:
-    actype = isolate_action(act)
-    tmp: str = isolate_arguments(act)
-    if tmp == "":
-        HeaderGenerator().execute_action_type(actype,tuple([tmp]))
+        entries = []
+        for e in os.scandir(directory):
+            if e.name.endswith(suffix):
+                entries.append((e.stat().st_mtime, e.path))
+    except OSError:
         return
-    tmp = separate_arguments(tmp)
-    tmp = remove_spaces(tmp)
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries)-max_entries]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-    #print(tmp)
+"""
 
-    # send as tuple...
-    ASSERT_LIST(tmp)
-    HeaderGenerator().execute_action_type(actype, tuple(tmp))
+Build index
 
-def do_actions(actions: List[str]) -> None:
-    for x in actions:
-        do_action(x)
-
-def generate_templated_header(xfile: str) -> str:
-    hgenst = HGenState()
-    macro_define = hgenst.macro_prefix + "_" + xfile + "_H_"
-    licnot = hgenst.license_notice
-
-    ret: str = ""
-    if licnot != "":
-        ret+="/*\n{}\n*/\n\n".format(licnot)
-    ret+="#ifndef {}\n#define {}\n\n#endif".format(
-        macro_define,macro_define
-    )
+"""
 
-    return ret
+# What each script's last successful run read and wrote, kept next to
+# the PlanCache (and disabled along with it, by --no-cache). A record
+# holds the stat of every input (the script, license notices, templates,
+# includes, scanned directories) and the stat and digest of every
+# header. When none of them changed, run_from_hgen_script returns after
+# stat'ing them, without reading or parsing anything. Otherwise every
+# header is still rendered, but those whose stat and digest match the
+# record are not read back or rewritten. Records are keyed by the
+# working directory and the script's absolute path (relative paths in a
+# script depend on both), the settings the script starts from and the
+# running code (see code_version)
+class BuildIndex(SingletonBase):
+    __MAGIC = b"HGENF1\n"
+    # bump whenever a record changes shape
+    __FORMAT = 1
 
+    def __SINGLETON_INIT__(self):
+        self.max_entries: int = HGenEnvars.get("BuildIndexMaxEntries")
+        # an input modified this close to the record being written may
+        # have changed again within the same mtime tick, such a record
+        # never counts as up to date
+        self.racy_ns: int = int(HGenEnvars.get("BuildIndexRacySeconds") * 1e9)
+
+    def enabled(self) -> bool:
+        return PlanCache().enabled
+
+    def key_for(self, xfile: str, state: HGenState) -> str:
+        import hashlib
+        h = hashlib.sha256()
+        h.update(repr((
+            __version__, self.__FORMAT, os.getcwd(), os.path.abspath(xfile),
+            state.fingerprint(), code_version()
+        )).encode("utf-8", "surrogatepass"))
+        return h.hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(PlanCache().directory, key + ".hgenf")
+
+    # the record of xfile's last run, or None
+    @profiled("BuildIndex.load")
+    def load(self, key: str, xfile: str) -> tuple or None:
+        if not self.enabled():
+            return None
+        import marshal
+        path = self.path_for(key)
+        try:
+            f = io.open(path, "rb")
+            try:
+                dat = f.read()
+            finally:
+                f.close()
+            if not dat.startswith(self.__MAGIC):
+                raise ValueError("bad magic")
+            record = marshal.loads(dat[len(self.__MAGIC):])
+            if record[0] != key:
+                raise ValueError("key mismatch")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, TypeError, IndexError) as err:
+            Logger().print("BuildIndex.load",
+                "Ignoring unusable record {}: {}",path,err,
+                level=LogLevel.get("WARNING"))
+            return None
+        return record
+
+    # whether nothing in record changed since, checking stats only
+    @profiled("BuildIndex.check")
+    def is_up_to_date(self, record: tuple) -> bool:
+        _, stored_ns, _, _, inputs, outputs = record
+        for path, size, mtime_ns in inputs:
+            if mtime_ns >= stored_ns - self.racy_ns:
+                return False
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return False
+        for path, size, mtime_ns, _ in outputs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return False
+        if (__debug__):
+            Logger().print("BuildIndex.is_up_to_date","Nothing changed")
+        return True
+
+    # what run_from_hgen_script would have reported for an up to date run
+    def stats_from(self, record: tuple) -> HGenRunStats:
+        stats = HGenRunStats()
+        stats.up_to_date = True
+        stats.unchanged = record[2]
+        stats.inputs = [path for path, _, _ in record[4]]
+        stats.outputs = list(record[3])
+        return stats
+
+    # path -> (size, mtime_ns, digest) of the headers in record
+    def known_outputs(self, record: tuple or None) -> dict:
+        if record == None:
+            return {}
+        return {path: (size, mtime_ns, digest)
+            for path, size, mtime_ns, digest in record[5]}
+
+    # records a successful run. an input or header without a stat
+    # makes the run unrecordable
+    @profiled("BuildIndex.store")
+    def store(self, key: str, xfile: str, stats: HGenRunStats) -> None:
+        if not self.enabled():
+            return
+        import time
+        import marshal
+        stored_ns = time.time_ns()
+        outputs = {}
+        for path, size, mtime_ns, digest in stats.fingerprints:
+            outputs[path] = (path, size, mtime_ns, digest)
+        if any(p not in outputs for p in stats.outputs):
+            return
+        inputs = {}
+        for rec in stats.input_stats:
+            inputs.setdefault(rec[0], rec)
+        if any(p not in inputs for p in stats.inputs):
+            return
+
+        dat = self.__MAGIC + marshal.dumps((key, stored_ns,
+            stats.written + stats.unchanged, tuple(stats.outputs),
+            tuple(inputs.values()), tuple(outputs.values())))
+        path = self.path_for(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Swrite_bytes_to(path, dat)
+        except OSError as err:
+            Logger().print("BuildIndex.store",
+                "Could not record {} in {}: {}",xfile,path,err,
+                level=LogLevel.get("WARNING"))
+            return
+        prune_cache_files(os.path.dirname(path), ".hgenf", self.max_entries)
 
-# run the hgen from this script file...
-def run_from_hgen_script(xfile: str) -> None:
-    scriptD: str = Sread_from(xfile)
+"""
 
-    actions: List[str] = find_actions(parse_script(scriptD))
-    are_actions_valid(actions)
-    do_actions(actions)
-
-def parse_script(d: str) -> str:
-    d = lose_comments(d)
-    return lose_newlines(d)
-
-def lose_comments(d: str) -> str:
-    slist: List[str] = d.split("\n")
-    ret: str = ""
-    for x in slist:
-        x = x+"\n"
-        if x.startswith("#"):
-            x = ""
+Included script cache
+
+"""
+
+# The actions of INCLUDE'd scripts, shared by every script run in this
+# process so that a preamble included by a whole batch is only read and
+# parsed once. Keyed and validated like LicenseCache; a miss still goes
+# through the PlanCache, unless use_plan_cache says otherwise
+class IncludeCache(SingletonBase):
+
+    def __SINGLETON_INIT__(self):
+        self.entries = {} # abspath -> (size, mtime_ns, actions)
+
+    def load(self, filepath: str,
+        use_plan_cache: bool = True) -> List[HGenAction]:
+        ASSERT_STR(filepath)
+        key = os.path.abspath(filepath)
+        st = os.stat(key)
+        entry = self.entries.get(key)
+        if entry != None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            if (__debug__):
+                Logger().print("IncludeCache.load","Hit for {}",filepath)
+            return entry[2]
+
+        if (__debug__):
+            Logger().print("IncludeCache.load","Miss for {}",filepath)
+        actions = load_plan(Sread_from(filepath), filepath, use_plan_cache)
+        self.entries[key] = (st.st_size, st.st_mtime_ns, actions)
+        return actions
+
+
+"""
+
+Batch runs
+
+"""
+
+# order preserving, without duplicates
+def unique_paths(paths) -> List[str]:
+    seen = set()
+    return [p for p in paths if not (p in seen or seen.add(p))]
+
+# --run values: plain files, directories (every *.hgen below them) and
+# glob patterns, in the order given and without duplicates
+def expand_script_paths(values: List[str]) -> List[str]:
+    paths: List[str] = []
+    for v in values:
+        if os.path.isdir(v):
+            found: List[str] = []
+            for root, dirs, files in os.walk(v):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.endswith(".hgen"):
+                        found.append(os.path.join(root, f))
+            paths.extend(found)
+        elif any(c in v for c in "*?["): # only import glob when needed
+            import glob
+            paths.extend(sorted(glob.glob(v, recursive=True)))
         else:
-            # search for the comment start
-            for index,c in enumerate(x,start=0):
-                if c == "#":
-                    x = x[0:index]+"\n"
-                    break
+            paths.append(v)
+
+    return unique_paths(paths)
+
+# runs one script from fresh settings, reporting failure instead of
+# raising so a batch always finishes. jobs/use_cache are passed along
+# explicitly because pool workers may be spawned rather than forked.
+# headers written under "batch" durability are left in the stats'
+# unsynced, even when the script failed
+def run_script_isolated(xfile: str, jobs_override: int = None,
+    use_cache: bool = True, profile: bool = False,
+    trace: bool = False,
+    durability_override: str = None,
+    streaming: bool = False,
+    shards: int = 1) -> Tuple[str, HGenRunStats, str or None]:
+    ctx = HGenContext(jobs_override=jobs_override,
+        durability_override=durability_override,
+        streaming=streaming, shards=shards, deferred_sync=True)
+    PlanCache().enabled = use_cache
+    if profile: # collected here, handed back with the stats
+        Profiler().reset()
+        Profiler().start(trace)
 
-        ret+=x
+    try:
+        ret = (xfile, run_from_hgen_script(xfile, ctx), None)
+    except Exception as err:
+        if (__debug__):
+            import traceback
+            traceback.print_exc()
+        ret = (xfile, ctx.stats, "{}: {}".format(type(err).__name__, err))
+    if profile:
+        Profiler().stop()
+        ret[1].profile = Profiler().snapshot()
     return ret
 
-def lose_newlines(d: str) -> str:
-    slist: List[str] = d.split("\n")
-    ret: str = ""
-    for x in slist:
-        ret+=x
+# runs every script (in-process for one, otherwise across up to
+# `processes` worker processes) and returns run_script_isolated's results.
+# what they wrote under "batch" durability is synced once, at the end
+def run_scripts_results(xfiles: List[str],
+    processes: int = None) -> List[Tuple[str, HGenRunStats, str or None]]:
+    ctx = default_context()
+    jobs_override = ctx.jobs_override
+    durability_override = ctx.durability_override
+    streaming = ctx.streaming
+    shards = ctx.shards
+    use_cache = PlanCache().enabled
+
+    # a single script runs right here, under the caller's profiler
+    if len(xfiles) == 1:
+        return sync_results([run_script_isolated(xfiles[0], jobs_override,
+            use_cache, durability_override=durability_override,
+            streaming=streaming, shards=shards)])
+
+    from concurrent.futures import ProcessPoolExecutor
+    profiler = Profiler()
+    profile = Profiler.enabled
+    workers = min(processes or os.cpu_count() or 1, len(xfiles))
+    n = len(xfiles)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            run_script_isolated, xfiles, [jobs_override]*n, [use_cache]*n,
+            [profile]*n, [profile and profiler.trace]*n,
+            [durability_override]*n, [streaming]*n, [shards]*n
+        ))
+    for _, stats, _ in results:
+        if stats.profile != None:
+            profiler.merge(stats.profile)
+            stats.profile = None
+    return sync_results(results)
+
+# the one sync_outputs of a batch, for every script's unsynced headers
+def sync_results(results: List[Tuple[str, HGenRunStats, str or None]]
+    ) -> List[Tuple[str, HGenRunStats, str or None]]:
+    sync_outputs([p for _, stats, _ in results for p in stats.unsynced])
+    for _, stats, _ in results:
+        stats.unsynced = []
+    return results
+
+# also writes the depfile/manifest (see write_depfile/write_manifest)
+# when asked to, once every script succeeded
+def run_scripts(xfiles: List[str], processes: int = None,
+    depfile: str = None, manifest: str = None) -> int:
+    results = run_scripts_results(xfiles, processes)
+    status = report_results(results)
+    if status == 0:
+        if depfile != None:
+            write_depfile(depfile, results, manifest)
+        if manifest != None:
+            write_manifest(manifest, results)
+    return status
+
+# run_scripts under the Profiler, printing its summary to stderr and
+# optionally saving it as JSON and/or a Chrome trace
+def run_scripts_profiled(xfiles: List[str], processes: int = None,
+    json_file: str = None, trace_file: str = None,
+    depfile: str = None, manifest: str = None) -> int:
+    profiler = Profiler()
+    profiler.start(trace=trace_file != None)
+    try:
+        status = run_scripts(xfiles, processes, depfile, manifest)
+    finally:
+        profiler.stop()
+    print(profiler.summary(), file=sys.stderr)
+    if json_file != None:
+        profiler.write_json(json_file, profiler.to_json())
+    if trace_file != None:
+        profiler.write_json(trace_file, profiler.to_chrome_trace())
+    return status
+
+# escapes a path the way make (and ninja's depfile parser) read it
+def depfile_escape(path: str) -> str:
+    ret = ""
+    for c in path.replace("\\", "/") if os.sep == "\\" else path:
+        if c in " #":
+            ret += "\\" + c
+        elif c == "$":
+            ret += "$$"
+        else:
+            ret += c
     return ret
 
-def find_actions(d: str) -> List[str]:
-    actions_pat = re.compile(r'[a-zA-Z0-9_]+\([a-zA-Z0-9/_,\. ]+\)')
+# a Makefile/ninja depfile: every generated header (and the manifest,
+# if one is written too) depends on the scripts and everything they read
+def write_depfile(filepath: str,
+    results: List[Tuple[str, HGenRunStats, str or None]],
+    manifest: str = None) -> None:
+    targets = unique_paths(p for _, stats, _ in results for p in stats.outputs)
+    if manifest != None:
+        targets.append(manifest)
+    if not targets: # make needs something on the left
+        targets.append(filepath)
+    deps = unique_paths(p for _, stats, _ in results for p in stats.inputs)
+    Swrite_to(filepath, "{}: {}\n".format(
+        " ".join(depfile_escape(p) for p in targets),
+        " \\\n  ".join(depfile_escape(p) for p in deps)
+    ))
+
+# the inputs and outputs of a run as JSON, in total and per script
+def write_manifest(filepath: str,
+    results: List[Tuple[str, HGenRunStats, str or None]]) -> None:
+    import json
+    Swrite_to(filepath, json.dumps({
+        "inputs": unique_paths(
+            p for _, stats, _ in results for p in stats.inputs),
+        "outputs": unique_paths(
+            p for _, stats, _ in results for p in stats.outputs),
+        "scripts": {
+            xfile: {
+                "inputs": unique_paths(stats.inputs),
+                "outputs": unique_paths(stats.outputs),
+            } for xfile, stats, _ in results
+        },
+    }, indent=2) + "\n")
+
+# prints the outcome of a (batch) run and returns its exit status
+def report_results(results: List[Tuple[str, HGenRunStats, str or None]],
+    named: bool = False) -> int:
+    total = HGenRunStats()
+    failed = 0
+    for xfile, stats, err in results:
+        total.add(stats)
+        if err != None:
+            failed += 1
+            print("ERROR: {}: {}".format(xfile, err), file=sys.stderr)
+        elif named or len(results) > 1:
+            print("{}: {}".format(xfile, stats.report()))
+
+    if len(results) > 1:
+        print("{} script(s), {} failed: {}".format(
+            len(results), failed, total.report()))
+    elif not named: # the one script's own report, up to date or not
+        print(results[0][1].report() if results else total.report())
+    return 1 if failed else 0
 
-    actionList: List[str] = []
-    for x in re.findall(actions_pat,d):
-        actionList.append(x)
+"""
 
-    return actionList
+Watch mode
 
-def are_actions_valid(actions: List[str]) -> bool:
-    for x in actions:
-        if not is_valid_action(x):return False
-    return True
+"""
 
-def is_valid_action(action: str) -> bool:
-    a = action.split("(")[0]
-    if not (a in HeaderGenerator().builtin_actions):
-        raise InvalidActionError("{} is not a valid Action!".format(a))
-    return True
+# inotify based change detection (Linux only). The directories holding
+# the watched files are watched rather than the files themselves, since
+# editors tend to save by replacing a file. A watched directory (an
+# input of GENERATE_HEADERS_FROM) is watched itself too, and changes
+# when an entry is added to, removed from or renamed in it
+class InotifyWatcher(object):
+    __name__='InotifyWatcher'
+    __IN_MODIFY = 0x002
+    __IN_ATTRIB = 0x004
+    __IN_CLOSE_WRITE = 0x008
+    __IN_MOVED_FROM = 0x040
+    __IN_MOVED_TO = 0x080
+    __IN_CREATE = 0x100
+    __IN_DELETE = 0x200
+    __IN_IGNORED = 0x8000
+    __IN_NONBLOCK = 0o4000
+    __IN_CLOEXEC = 0o2000000
+    __EVENT_SIZE = 16 # struct inotify_event without its name
+
+    def __init__(self) -> None:
+        import ctypes
+        import ctypes.util
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = self.__libc.inotify_init1(self.__IN_NONBLOCK | self.__IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.__fd: int = fd
+        self.__mask: int = (self.__IN_MODIFY | self.__IN_ATTRIB |
+            self.__IN_CLOSE_WRITE | self.__IN_MOVED_FROM | self.__IN_MOVED_TO |
+            self.__IN_CREATE | self.__IN_DELETE)
+        self.__dirs = {} # watch descriptor -> directory
+        self.__watched = set()
+        self.__paths = set()
+        self.__input_dirs = set()
+
+    def watch(self, paths) -> None:
+        self.__paths = set(paths)
+        self.__input_dirs = {p for p in self.__paths if os.path.isdir(p)}
+        for d in {os.path.dirname(p) for p in self.__paths} | self.__input_dirs:
+            if d in self.__watched:
+                continue
+            wd = self.__libc.inotify_add_watch(
+                self.__fd, os.fsencode(d or "."), self.__mask)
+            if wd < 0:
+                Logger().print("InotifyWatcher.watch",
+                    "Cannot watch {}",d,level=LogLevel.get("WARNING"))
+                continue
+            self.__dirs[wd] = d
+            self.__watched.add(d)
+
+    # the watched paths changed within timeout seconds (None blocks)
+    def poll(self, timeout: float = None) -> set:
+        import select
+        import struct
+        changed = set()
+        if not select.select([self.__fd], [], [], timeout)[0]:
+            return changed
+        try:
+            buf = os.read(self.__fd, 65536)
+        except BlockingIOError:
+            return changed
+
+        entry_events = (self.__IN_CREATE | self.__IN_DELETE |
+            self.__IN_MOVED_FROM | self.__IN_MOVED_TO)
+        off = 0
+        while off + self.__EVENT_SIZE <= len(buf):
+            wd, mask, _, nlen = struct.unpack_from("iIII", buf, off)
+            name = buf[off+self.__EVENT_SIZE:off+self.__EVENT_SIZE+nlen]
+            off += self.__EVENT_SIZE + nlen
+            d = self.__dirs.get(wd)
+            if d == None:
+                continue
+            if mask & self.__IN_IGNORED: # d is gone, the next watch() retries
+                del self.__dirs[wd]
+                self.__watched.discard(d)
+                continue
+            if nlen == 0: # about d itself, its entry in its parent tells more
+                continue
+            p = os.path.join(d, os.fsdecode(name.rstrip(b"\0")))
+            if p in self.__paths:
+                changed.add(p)
+            if d in self.__input_dirs and mask & entry_events:
+                changed.add(d)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.__fd)
+
+# portable fallback, compares a (mtime, size, inode) stat signature
+class PollWatcher(object):
+    __name__='PollWatcher'
+
+    def __init__(self, interval: float = None) -> None:
+        self.__interval: float = interval or HGenEnvars.get("WatchPollSeconds")
+        self.__sigs = {}
+
+    @staticmethod
+    def signature(p: str) -> Tuple[int, int, int] or None:
+        try:
+            st = os.stat(p)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def watch(self, paths) -> None:
+        self.__sigs = {
+            p: (self.__sigs[p] if p in self.__sigs else self.signature(p))
+            for p in paths
+        }
+
+    def poll(self, timeout: float = None) -> set:
+        import time
+        deadline = None if timeout == None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for p, old in self.__sigs.items():
+                new = self.signature(p)
+                if new != old:
+                    self.__sigs[p] = new
+                    changed.add(p)
+            if changed:
+                return changed
+            wait = self.__interval
+            if deadline != None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return changed
+            time.sleep(wait)
+
+    def close(self) -> None:
+        return
+
+def make_watcher() -> InotifyWatcher or PollWatcher:
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as err:
+            Logger().print("make_watcher",
+                "inotify unavailable ({}), polling instead",err,
+                level=LogLevel.get("INFO"))
+    return PollWatcher()
+
+# blocks until something changes, then keeps collecting until the
+# watched files have been quiet for `debounce` seconds
+def wait_for_changes(watcher, debounce: float = None) -> set:
+    if debounce == None:
+        debounce = HGenEnvars.get("WatchDebounceSeconds")
+    changed = set()
+    while not changed:
+        changed = watcher.poll(None)
+    while True:
+        more = watcher.poll(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+# runs the scripts, then re-runs a script whenever it or a file it read
+# (e.g. its license notice source) changes, until interrupted
+def watch_scripts(xfiles: List[str], processes: int = None) -> int:
+    watcher = make_watcher()
+    deps = {}
+
+    def run(targets: List[str]) -> None:
+        results = run_scripts_results(targets, processes)
+        report_results(results, named=True)
+        for xfile, stats, _ in results:
+            deps[xfile] = {os.path.abspath(p) for p in [xfile] + stats.inputs}
+        watcher.watch(set().union(*deps.values()))
+
+    run(xfiles)
+    print("Watching {} file(s) for changes, press Ctrl-C to stop".format(
+        len(set().union(*deps.values()))))
+    try:
+        while True:
+            changed = wait_for_changes(watcher)
+            Logger().print("watch_scripts","Changed: {}",
+                ", ".join(sorted(changed)),level=LogLevel.get("INFO"))
+            affected = [x for x in xfiles if deps[x] & changed]
+            if affected:
+                run(affected)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+"""
+
+Server mode
+
+"""
+
+def default_socket_path() -> str:
+    return os.environ.get(HGenEnvars.get("ServeSocketEnvar")) or os.path.join(
+        PlanCache.default_directory(), "headergen.sock")
+
+# A warm HeaderGen process on a Unix domain socket, so that build steps
+# don't each pay for starting one. The protocol is one line of JSON per
+# direction on a fresh connection:
+#     request  {"cwd": "/abs/dir", "args": ["--run", "x.hgen", ...]}
+#     response {"status": 0, "stdout": "...", "stderr": "..."}
+# "args" is a regular command line, run as if from "cwd". Connections
+# are served concurrently, but runs take turns: the working directory,
+# sys.stdout/stderr and default_context() are process wide. The parse
+# (PlanCache, kept in memory too) and license caches stay warm across
+# requests. Stops once idle for idle_timeout seconds (0 never does)
+class HGenServer(object):
+    __name__='HGenServer'
+    # commands that make no sense inside the server
+    __REFUSED = ("--serve", "--connect", "--watch")
+
+    def __init__(self, path: str, idle_timeout: float) -> None:
+        import threading
+        self.path: str = path
+        self.idle_timeout: float = idle_timeout
+        self.__run_lock = threading.Lock()
+        self.__count_lock = threading.Lock()
+        self.__active: int = 0
+        self.__last_active: float = 0.0
+        self.__sock = None
+
+    def bind(self) -> None:
+        import socket
+        if os.path.exists(self.path):
+            # a socket nobody answers on is left over from a crash
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.remove(self.path)
+            else:
+                raise InvalidArgumentError(
+                    "a server is already listening on {}".format(self.path))
+            finally:
+                probe.close()
+        else:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077) # only this user may connect
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(64)
+        sock.settimeout(0.5) # how often the idle timeout is checked
+        self.__sock = sock
+
+    def serve(self) -> int:
+        import socket
+        import threading
+        import time
+        self.bind()
+        print("Serving on {}, press Ctrl-C to stop".format(self.path))
+        self.__last_active = time.monotonic()
+        try:
+            while True:
+                try:
+                    conn, _ = self.__sock.accept()
+                except socket.timeout:
+                    if self.idle_timeout > 0 and self.__idle_for(
+                        time.monotonic()) >= self.idle_timeout:
+                        print("Idle for {}s, stopping".format(self.idle_timeout))
+                        return 0
+                    continue
+                conn.settimeout(None)
+                with self.__count_lock:
+                    self.__active += 1
+                threading.Thread(target=self.__handle, args=(conn,),
+                    daemon=True).start()
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            self.__sock.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __idle_for(self, now: float) -> float:
+        with self.__count_lock:
+            if self.__active:
+                return 0.0
+            return now - self.__last_active
+
+    def __handle(self, conn) -> None:
+        import json
+        import time
+        try:
+            f = conn.makefile("rwb")
+            try:
+                line = f.readline(HGenEnvars.get("ServeMaxRequestBytes"))
+                try:
+                    req = json.loads(line.decode("utf-8"))
+                    cwd, args = req["cwd"], req["args"]
+                    if not (isinstance(cwd, str) and isinstance(args, list)
+                        and all(isinstance(a, str) for a in args)):
+                        raise TypeError("cwd must be a string, args a list of strings")
+                except (ValueError, KeyError, TypeError) as err:
+                    reply = {"status": 2, "stdout": "",
+                        "stderr": "ERROR: bad request: {}\n".format(err)}
+                else:
+                    reply = self.run(cwd, args)
+                f.write(json.dumps(reply).encode("utf-8") + b"\n")
+                f.flush()
+            finally:
+                f.close()
+        except OSError: # the client went away
+            pass
+        finally:
+            conn.close()
+            with self.__count_lock:
+                self.__active -= 1
+                self.__last_active = time.monotonic()
+
+    # runs one command line, returning its exit status and output. the
+    # process wide settings a command line can change are put back after
+    def run(self, cwd: str, args: List[str]) -> dict:
+        import contextlib
+        refused = [a for a in args if a in self.__REFUSED]
+        if refused:
+            return {"status": 2, "stdout": "",
+                "stderr": "ERROR: {} is not available through the server\n".format(
+                    refused[0])}
+
+        out, err = io.StringIO(), io.StringIO()
+        with self.__run_lock:
+            ctx = default_context()
+            cache = PlanCache()
+            saved = (os.getcwd(), ctx.options(), cache.enabled, Logger.level)
+            try:
+                with contextlib.redirect_stdout(out), \
+                    contextlib.redirect_stderr(err):
+                    try:
+                        os.chdir(cwd)
+                        status = act_on_parse(args)
+                    except SystemExit as e: # --help
+                        status = e.code if isinstance(e.code, int) else 0
+                    except Exception as e:
+                        if (__debug__):
+                            import traceback
+                            traceback.print_exc()
+                        print("ERROR: {}: {}".format(type(e).__name__, e),
+                            file=sys.stderr)
+                        status = 1
+            finally:
+                os.chdir(saved[0])
+                ctx.set_options(saved[1])
+                cache.enabled, Logger.level = saved[2:]
+        return {"status": status, "stdout": out.getvalue(),
+            "stderr": err.getvalue()}
+
+def serve(path: str = None, idle_timeout: float = None) -> int:
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        print("ERROR: --serve needs Unix domain sockets", file=sys.stderr)
+        return 1
+    PlanCache().keep_in_memory()
+    return HGenServer(path or default_socket_path(),
+        HGenEnvars.get("ServeIdleSeconds") if idle_timeout == None
+        else idle_timeout).serve()
+
+# sends a command line to a --serve process and relays its output,
+# returning its exit status, or None when no server could be reached
+def run_via_server(args: List[str], path: str = None) -> int or None:
+    import socket
+    import json
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path or default_socket_path())
+        except OSError:
+            return None
+        sock.sendall(json.dumps(
+            {"cwd": os.getcwd(), "args": args}).encode("utf-8") + b"\n")
+        f = sock.makefile("rb")
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+    finally:
+        sock.close()
+    if not line:
+        return None
+    reply = json.loads(line.decode("utf-8"))
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    return reply["status"]
 
 
 """
@@ -637,12 +3370,56 @@ Help:
             Provides a help dialog
         --new (optional: file) :
             Creates a new templated HeaderGen script!
-        --run (required: file) :
-            Runs the templated HeaderGen script!
+        --run (required: file(s), directories or globs) :
+            Runs the templated HeaderGen script(s)! Several scripts are
+            run in one invocation, spread across a process pool
+        --processes (required: count) :
+            Size of the process pool used when running several scripts
+        --watch (required: file(s), directories or globs) :
+            Like --run, then keeps running and re-runs a script whenever
+            it or its license notice source changes
+        --jobs (required: count) :
+            Renders and writes headers with this many worker threads
+            (overrides SET_JOBS in the script)
+        --shards (required: count) :
+            Spreads the headers of each GENERATE_HEADERS over this many
+            worker processes, in shards of {} (each using --jobs threads)
+        --durability (required: none, file or batch) :
+            How hard written headers are pushed to disk: not at all,
+            fsync each file, or fsync them all once every script has run
+            (overrides SET_DURABILITY in the script)
+        --serve (optional: socket) :
+            Keeps a warm HeaderGen running on a Unix domain socket
+            (default $HGEN_SOCKET or headergen.sock in the cache dir)
+        --idle-timeout (required: seconds) :
+            Stops --serve after this long without requests (default
+            {}, 0 never stops)
+        --connect (optional: socket) :
+            Hands the rest of the command line to a --serve process,
+            or runs it here if there is none
+        --depfile (required: file) :
+            With --run, writes a Makefile/ninja depfile: the generated
+            headers depend on the script(s), license notices and templates
+        --manifest (required: file) :
+            With --run, writes the inputs and generated headers as JSON
+        --stream :
+            Reads the script(s) in chunks and writes each header as its
+            name is parsed, keeping memory flat for huge scripts
+            (skips the plan cache and build index, no --depfile/--manifest)
+        --no-cache :
+            Always re-parse the script instead of using the cached plan
+        --profile (optional: file) :
+            Prints per-phase wall time, calls, bytes read/written and
+            memory peaks at exit, and writes them to file as JSON
+        --profile-trace (required: file) :
+            Like --profile, and also writes a Chrome trace to file
+        --log-level (required: DEBUG, INFO, WARNING or ERROR) :
+            Drops development mode log records below this level
 """.format(
     __project_name__,
     __version__[0],__version__[1],__version__[2],__version__[3],
-    __author__)
+    __author__, HGenEnvars.get("ShardSize"),
+    HGenEnvars.get("ServeIdleSeconds"))
 )
     sys.exit() # exit after help message...
 
@@ -669,12 +3446,25 @@ def does_arg_or_not(what_arg: str, args: List[str]) -> Tuple[str, bool]:
         if (x == what_arg):
             # check if the arg list is even long enough,
             # if so, return the supplied value to that arg
-            # along with true
-            if (len(args) > index+1):
-                return (args[index], True)
+            # along with true (unless the next arg is another option)
+            if (len(args) > index+1 and not args[index+1].startswith("--")):
+                return (args[index+1], True)
             else:return (None, True)
     return (None, False)
 
+# like does_arg_or_not, but for options taking several values:
+# returns every arg following it up to the next option
+def collect_arg_values(what_arg: str, args: List[str]) -> Tuple[List[str], bool]:
+    what_arg = "--"+what_arg
+    for index,x in enumerate(args,start=0):
+        if (x == what_arg):
+            values: List[str] = []
+            for v in args[index+1:]:
+                if v.startswith("--"):break
+                values.append(v)
+            return (values, True)
+    return ([], False)
+
 def did_arg_exist(v: Tuple[str, bool]) -> bool:
     return v[1]
 
@@ -685,40 +3475,124 @@ def did_arg_supply_value(v: Tuple[str, bool]):
 def get_arg_value(v: Tuple[str, bool]) -> str:
     return v[0]
 
-def act_on_parse(args: List[str]) -> None:
-    Logger().print("act_on_parse","Parsing ARGV")
+# --log-level, applied before anything else is done (or logged)
+def apply_log_level(args: List[str]) -> None:
+    log_level_arg: Tuple[str, bool] = does_arg_or_not("log-level",args)
+    if did_arg_exist(log_level_arg):
+        Logger.level = LogLevel.from_name(get_arg_value(log_level_arg))
+
+def act_on_parse(args: List[str]) -> int:
+    apply_log_level(args)
+    if (__debug__):
+        Logger().print("act_on_parse","Parsing ARGV")
+
+    connect_arg: Tuple[str, bool] = does_arg_or_not("connect",args)
+    if did_arg_exist(connect_arg):
+        index = args.index("--connect")
+        rest = args[:index] + args[index+(
+            2 if did_arg_supply_value(connect_arg) else 1):]
+        status = run_via_server(rest, get_arg_value(connect_arg))
+        if status != None:
+            return status
+        if (__debug__):
+            Logger().print("act_on_parse",
+                "No server to connect to, running here",
+                level=LogLevel.get("INFO"))
+        args = rest
 
     if (does_need_help(args)):
         HELP_MESSAGE()
     else: # catch all...
+        serve_arg: Tuple[str, bool] = does_arg_or_not("serve",args)
         new_arg: Tuple[str, bool] = does_arg_or_not("new",args)
-        run_arg: Tuple[str, bool] = does_arg_or_not("run",args)
+        run_arg: Tuple[List[str], bool] = collect_arg_values("run",args)
+        watch_arg: Tuple[List[str], bool] = collect_arg_values("watch",args)
+        jobs_arg: Tuple[str, bool] = does_arg_or_not("jobs",args)
+        procs_arg: Tuple[str, bool] = does_arg_or_not("processes",args)
+        durability_arg: Tuple[str, bool] = does_arg_or_not("durability",args)
+        shards_arg: Tuple[str, bool] = does_arg_or_not("shards",args)
+
+        if did_arg_exist(does_arg_or_not("no-cache",args)):
+            PlanCache().enabled = False
+        if did_arg_exist(does_arg_or_not("stream",args)):
+            default_context().streaming = True
+        if did_arg_exist(jobs_arg):
+            default_context().jobs_override = parse_jobs_value(
+                get_arg_value(jobs_arg)
+            )
+        if did_arg_exist(durability_arg):
+            default_context().durability_override = parse_durability_value(
+                get_arg_value(durability_arg)
+            )
+        if did_arg_exist(shards_arg):
+            default_context().shards = parse_jobs_value(
+                get_arg_value(shards_arg), "shards"
+            )
+
+        # KEEP A WARM PROCESS AROUND FOR --connect
+        if did_arg_exist(serve_arg):
+            idle_arg: Tuple[str, bool] = does_arg_or_not("idle-timeout",args)
+            return serve(get_arg_value(serve_arg),
+                parse_seconds_value(get_arg_value(idle_arg))
+                if did_arg_exist(idle_arg) else None)
 
         # CREATE NEW TEMPLATED HEADER GEN SCRIPT
-        if did_arg_exist(new_arg):
+        elif did_arg_exist(new_arg):
             if did_arg_supply_value(new_arg):
                 create_templated_hgen_script(get_arg_value(new_arg))
             else: # create with default filename
                 create_templated_hgen_script(HGenEnvars.get("DefaultScriptFilename"))
 
-        # RUN HGEN SCRIPT
-        elif did_arg_exist(run_arg):
-            if did_arg_supply_value(run_arg):
-                run_from_hgen_script(get_arg_value(run_arg))
+        # RUN (OR WATCH) HGEN SCRIPT(S)
+        elif did_arg_exist(run_arg) or did_arg_exist(watch_arg):
+            scripts_arg = run_arg if did_arg_exist(run_arg) else watch_arg
+            processes = None
+            if did_arg_exist(procs_arg):
+                processes = parse_jobs_value(get_arg_value(procs_arg))
+
+            if get_arg_value(scripts_arg):
+                xfiles = expand_script_paths(get_arg_value(scripts_arg))
+                if not xfiles:
+                    print("ERROR: no scripts matched {}".format(
+                        " ".join(get_arg_value(scripts_arg))), file=sys.stderr)
+                    return 1
             else: # assume default script name
-                run_from_hgen_script(HGenEnvars.get("DefaultScriptFilename"))
+                xfiles = [HGenEnvars.get("DefaultScriptFilename")]
+
+            if did_arg_exist(watch_arg):
+                return watch_scripts(xfiles, processes)
+
+            depfile_arg: Tuple[str, bool] = does_arg_or_not("depfile",args)
+            manifest_arg: Tuple[str, bool] = does_arg_or_not("manifest",args)
+            for a, name in ((depfile_arg, "depfile"), (manifest_arg, "manifest")):
+                if did_arg_exist(a) and not did_arg_supply_value(a):
+                    raise InvalidArgumentError("--{} requires a file".format(name))
+                if did_arg_exist(a) and default_context().streaming:
+                    raise InvalidArgumentError(
+                        "--{} needs the generated headers' paths, which "
+                        "--stream doesn't keep".format(name))
+
+            profile_arg: Tuple[str, bool] = does_arg_or_not("profile",args)
+            trace_arg: Tuple[str, bool] = does_arg_or_not("profile-trace",args)
+            if not (did_arg_exist(profile_arg) or did_arg_exist(trace_arg)):
+                return run_scripts(xfiles, processes,
+                    get_arg_value(depfile_arg), get_arg_value(manifest_arg))
+            return run_scripts_profiled(xfiles, processes,
+                get_arg_value(profile_arg), get_arg_value(trace_arg),
+                get_arg_value(depfile_arg), get_arg_value(manifest_arg))
 
         # still display help even if they didnt ask,
         # given they couldnt supply anything else
         else:
             HELP_MESSAGE2()
+    return 0
 
-def HGEN_ENTRY() -> None:
+def HGEN_ENTRY() -> int:
     # parse sys.argv...
     _ARGS: List[str] = sys.argv[1:] # ignore first arg, its useless
                          # (name of script ran)
 
-    act_on_parse(_ARGS)
+    return act_on_parse(_ARGS)
 
 
 """
@@ -727,18 +3601,27 @@ Entry-Point
 
 """
 def begin() -> None:
-    Logger() # pre-emptively create single logger instance
-    HGenState() # single state instance
-    HeaderGenerator() # single hgen instance
+    # singletons are created on first use, so commands that
+    # never touch them (--help, --new) don't pay for them
+    if (__debug__):
+        Logger() # the log gets dumped at the end either way
 def end() -> None:
-    Logger().dump() # dump the entirety of log
+    if (__debug__):
+        Logger().dump() # dump the entirety of log
 def main() -> NoReturn:
+    # batch runs use a process pool, which needs this in frozen builds
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+
+    # before begin(), so creating the singletons is logged at that level
+    apply_log_level(sys.argv[1:])
     begin() # pre-emptive initialize
 
-    HGEN_ENTRY()
+    status = HGEN_ENTRY()
 
     end() # perform necessary end actions
-    sys.exit()
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()
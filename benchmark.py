@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import contextlib
+import random
+import tempfile
+import platform
+import subprocess
+from enum import Enum
+from typing import List, Dict, Callable
+
+import HeaderGen
+
+# NOTES:
+# run with python's -OO argument to benchmark
+# the release build, otherwise debug mode
+# (debug log records are dropped either way)
+
+class Configuration(Enum):
+    HEADERS=10000
+    COMMENT_DENSITY=0.25
+    LICENSE_SIZE=1024
+    REPEAT=5
+    SEED=1234
+    TMPFS_DIR="/dev/shm"
+    STARTUP_RUNS=7
+    # milliseconds of imports a command may add on top of a bare
+    # interpreter (`python -X importtime -c pass`), best of STARTUP_RUNS.
+    # development mode also sets up the Logger, hence its bigger budget
+    STARTUP_BUDGET_MS={
+        "release":{"help":3.0, "new":3.0, "run":12.0},
+        "dev":{"help":8.0, "new":8.0, "run":16.0},
+    }
+
+    @classmethod
+    def get(cls, attrib: str) -> object:
+        return cls.__dict__[attrib].value
+
+class BenchmarkArgumentError(Exception):
+    pass
+
+###
+### SYNTHETIC INPUTS
+###
+
+def gen_license(size: int) -> str:
+    line = "Permission is hereby granted, free of charge, to any person.\n"
+    return (line * (size // len(line) + 1))[:size]
+
+# a script shaped like our machine generated ones: a settings preamble
+# followed by one big GENERATE_HEADERS, with comments sprinkled in
+def gen_script(headers: int, comment_density: float, license_path: str,
+    seed: int) -> str:
+    rnd = random.Random(seed)
+    lines: List[str] = [
+        "# synthetic HeaderGen benchmark script",
+        "SET_MACRO_PREFIX(BENCH)",
+        "SET_FILE_PREFIX(bench_)",
+        "SET_FILE_EXT(h)",
+        "SET_LICENSE_NOTICE_SOURCE({})".format(license_path),
+        "GENERATE_HEADERS(",
+    ]
+    for i in range(headers):
+        sep = "," if i < headers-1 else ""
+        if rnd.random() < comment_density:
+            lines.append("    header_{}{} # component {}".format(i, sep, i % 97))
+        else:
+            lines.append("    header_{}{}".format(i, sep))
+    lines.append(")")
+    return "\n".join(lines) + "\n"
+
+###
+### TIMING
+###
+
+def time_phase(fn: Callable[[], object], repeat: int,
+    setup: Callable[[], None] = None) -> Dict[str, float]:
+    samples: List[float] = []
+    for _ in range(repeat):
+        if setup != None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "best_s": samples[0],
+        "median_s": samples[len(samples)//2],
+        "worst_s": samples[-1],
+    }
+
+def per_item(result: Dict[str, float], items: int) -> Dict[str, float]:
+    result["items"] = items
+    result["best_us_per_item"] = result["best_s"] / max(items, 1) * 1e6
+    return result
+
+def write_phases(names: List[str], texts: List[str], outdir: str,
+    repeat: int) -> Dict[str, Dict[str, float]]:
+    paths = [os.path.join(outdir, "bench_{}.h".format(n)) for n in names]
+
+    def clear() -> None:
+        for p in paths:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def write_all() -> None:
+        for p, t in zip(paths, texts):
+            HeaderGen.Swrite_to(p, t)
+
+    def rewrite_unchanged() -> None:
+        for p, t in zip(paths, texts):
+            HeaderGen.Swrite_if_changed(p, t)
+
+    results = {
+        "Swrite_to": per_item(time_phase(write_all, repeat, clear), len(paths)),
+        "Swrite_if_changed_unchanged": per_item(
+            time_phase(rewrite_unchanged, repeat), len(paths)),
+    }
+    clear()
+    return results
+
+def run_benchmarks(headers: int, comment_density: float, license_size: int,
+    repeat: int, disk_dir: str, seed: int) -> Dict[str, object]:
+    HeaderGen.Logger.level = HeaderGen.LogLevel.get("ERROR")
+    HeaderGen.PlanCache().enabled = False
+
+    workdir = tempfile.mkdtemp(prefix="hgen_bench_", dir=disk_dir)
+    try:
+        license_path = os.path.join(workdir, "LICENSE.txt")
+        HeaderGen.Swrite_to(license_path, gen_license(license_size))
+        script = gen_script(headers, comment_density, license_path, seed)
+
+        phases: Dict[str, object] = {}
+        phases["parse_script"] = per_item(time_phase(
+            lambda: HeaderGen.parse_script(script), repeat), headers)
+
+        actions = HeaderGen.parse_script(script)
+        phases["are_actions_valid"] = per_item(time_phase(
+            lambda: HeaderGen.are_actions_valid(actions), repeat), len(actions))
+
+        # run the preamble so the state matches a real run
+        ctx = HeaderGen.HGenContext()
+        HeaderGen.do_actions(actions[:-1], ctx)
+        names = list(actions[-1].args)
+
+        # what each header used to pay just for looking at the settings
+        def read_state() -> None:
+            for _ in names:
+                st = ctx.state
+                st.macro_prefix, st.file_prefix, st.file_ext, st.license_notice
+        phases["HGenState_reads"] = per_item(time_phase(read_state, repeat),
+            len(names))
+        phases["generate_templated_header"] = per_item(time_phase(
+            lambda: [HeaderGen.generate_templated_header(n, ctx=ctx)
+                for n in names],
+            repeat), len(names))
+
+        texts = [HeaderGen.generate_templated_header(n, ctx=ctx) for n in names]
+        targets = {"disk": workdir}
+        tmpfs = Configuration.get("TMPFS_DIR")
+        if os.path.isdir(tmpfs) and os.access(tmpfs, os.W_OK):
+            targets["tmpfs"] = tempfile.mkdtemp(prefix="hgen_bench_", dir=tmpfs)
+        try:
+            for label, outdir in targets.items():
+                for phase, result in write_phases(names, texts, outdir,
+                    repeat).items():
+                    phases["{}[{}]".format(phase, label)] = result
+        finally:
+            if "tmpfs" in targets:
+                shutil.rmtree(targets["tmpfs"], ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "headergen_version": ".".join(str(v) for v in HeaderGen.__version__),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "headers": headers,
+            "comment_density": comment_density,
+            "license_size": license_size,
+            "repeat": repeat,
+            "seed": seed,
+            "script_bytes": len(script.encode("utf-8")),
+        },
+        "phases": phases,
+    }
+
+###
+### STARTUP
+###
+
+# total import time of a run, in microseconds, summed over the
+# top-level entries of `python -X importtime` (nested imports are
+# already included in their parent's cumulative time)
+def import_time_us(stderr: str) -> int:
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue # the header line
+        name = parts[2]
+        if len(name) - len(name.lstrip(" ")) == 1:
+            total += int(parts[1])
+    return total
+
+def time_command(argv: List[str], cwd: str, env: Dict[str, str],
+    runs: int) -> Dict[str, float]:
+    imports: List[int] = []
+    walls: List[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(argv, cwd=cwd, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        walls.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError("{} failed:\n{}".format(" ".join(argv), proc.stderr))
+        imports.append(import_time_us(proc.stderr))
+    return {
+        "imports_ms": min(imports) / 1e3,
+        "wall_ms": min(walls) * 1e3,
+    }
+
+# measures --help, --new and a small --run against STARTUP_BUDGET_MS
+def run_startup_budget(runs: int) -> Dict[str, object]:
+    python = [sys.executable, "-X", "importtime"]
+    if sys.flags.optimize:
+        python.append("-" + "O" * sys.flags.optimize)
+    target = os.path.abspath(HeaderGen.__file__)
+    mode = "dev" if __debug__ else "release"
+    budgets = Configuration.get("STARTUP_BUDGET_MS")[mode]
+
+    workdir = tempfile.mkdtemp(prefix="hgen_startup_")
+    try:
+        env = dict(os.environ)
+        env["HGEN_CACHE_DIR"] = os.path.join(workdir, "cache")
+        with open(os.path.join(workdir, "small.hgen"), "w") as f:
+            f.write(gen_script(3, 0.0, "LICENSE.txt", 0))
+        with open(os.path.join(workdir, "LICENSE.txt"), "w") as f:
+            f.write(gen_license(256))
+
+        baseline = time_command(python + ["-c", "pass"], workdir, env, runs)
+        commands = {
+            "help": [target, "--help"],
+            "new": [target, "--new", "new.hgen"],
+            # the first run fills the plan cache, like any repeat build
+            "run": [target, "--run", "small.hgen"],
+        }
+        results: Dict[str, object] = {}
+        over = False
+        for name, argv in commands.items():
+            r = time_command(python + argv, workdir, env, runs)
+            r["extra_imports_ms"] = max(r["imports_ms"] - baseline["imports_ms"], 0.0)
+            r["budget_ms"] = budgets[name]
+            r["within_budget"] = r["extra_imports_ms"] <= budgets[name]
+            over = over or not r["within_budget"]
+            results[name] = r
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "headergen_version": ".".join(str(v) for v in HeaderGen.__version__),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mode": mode,
+        "baseline": baseline,
+        "commands": results,
+        "within_budget": not over,
+    }
+
+###
+### ARGUMENTS
+###
+
+def get_arg(args: List[str], name: str, default: object, conv: Callable) -> object:
+    flag = "--"+name
+    if flag not in args:
+        return default
+    index = args.index(flag)
+    if len(args) <= index+1:
+        raise BenchmarkArgumentError("{} requires a value".format(flag))
+    try:
+        return conv(args[index+1])
+    except ValueError:
+        raise BenchmarkArgumentError(
+            "invalid value for {}: {!r}".format(flag, args[index+1]))
+
+def print_help() -> None:
+    print(
+"""
+HeaderGen benchmarks
+--------------------------------------------------------
+        --headers (count, default {}) :
+            Number of headers in the synthetic script
+        --comment-density (0..1, default {}) :
+            Fraction of script lines that carry a comment
+        --license-size (bytes, default {}) :
+            Size of the license notice
+        --repeat (count, default {}) :
+            Runs per phase, the best/median/worst are reported
+        --seed (int, default {}) :
+            Seed for where the synthetic script's comments go
+        --disk-dir (path, default: system temp dir) :
+            Where the on-disk write phases run
+        --output (path, default: stdout) :
+            Where the JSON results are written
+        --startup :
+            Instead of the phases above, check the import time of
+            --help, --new and a small --run against the startup budget
+            (exits with 1 when over budget)
+""".format(
+    Configuration.get("HEADERS"), Configuration.get("COMMENT_DENSITY"),
+    Configuration.get("LICENSE_SIZE"), Configuration.get("REPEAT"),
+    Configuration.get("SEED"))
+)
+
+###
+### ENTRY
+###
+
+def main() -> None:
+    args = sys.argv[1:]
+    if "--help" in args:
+        print_help()
+        sys.exit()
+
+    status = 0
+    # development mode chatter goes to stderr, keeping stdout pure JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        if "--startup" in args:
+            results = run_startup_budget(
+                get_arg(args, "repeat", Configuration.get("STARTUP_RUNS"), int))
+            status = 0 if results["within_budget"] else 1
+        else:
+            results = run_benchmarks(
+                get_arg(args, "headers", Configuration.get("HEADERS"), int),
+                get_arg(args, "comment-density", Configuration.get("COMMENT_DENSITY"), float),
+                get_arg(args, "license-size", Configuration.get("LICENSE_SIZE"), int),
+                get_arg(args, "repeat", Configuration.get("REPEAT"), int),
+                get_arg(args, "disk-dir", None, str),
+                get_arg(args, "seed", Configuration.get("SEED"), int),
+            )
+
+    dat = json.dumps(results, indent=2, sort_keys=True)
+    output = get_arg(args, "output", None, str)
+    if output != None:
+        with open(output, "w") as f:
+            f.write(dat + "\n")
+    else:
+        print(dat)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
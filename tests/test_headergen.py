@@ -0,0 +1,1206 @@
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import HeaderGen as HG
+
+def setUpModule():
+    HG.Logger.level = HG.LogLevel.get("ERROR")
+
+# runs each test in a fresh working directory, starting from the
+# default settings and with a PlanCache directory of its own
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="hgen-test-")
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        cache = HG.PlanCache()
+        self.saved_cache = (cache.enabled, cache.directory)
+        cache.enabled = True
+        cache.directory = os.path.join(self.tmp, ".cache")
+
+    def tearDown(self):
+        cache = HG.PlanCache()
+        cache.enabled, cache.directory = self.saved_cache
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def write(self, path: str, text: str) -> str:
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    # path -> bytes of every file below d
+    def tree(self, d: str) -> dict:
+        ret = {}
+        for root, _, files in os.walk(d):
+            for name in files:
+                p = os.path.join(root, name)
+                with open(p, "rb") as f:
+                    ret[os.path.relpath(p, d)] = f.read()
+        return ret
+
+"""
+
+Parsing
+
+"""
+
+# (name, args, line, col) of every action, or (error type, message)
+def parse_full(text: str):
+    try:
+        actions = HG.parse_script(text, "s.hgen")
+        HG.are_actions_valid(actions)
+    except Exception as err:
+        return (type(err).__name__, str(err))
+    return [(a.name, tuple(a.args), a.line, a.col) for a in actions]
+
+# parse_full through iter_stream_actions, the script in size-long chunks
+def parse_stream(text: str, size: int):
+    chunks = (text[i:i+size] for i in range(0, len(text), size))
+    ret = []
+    try:
+        for a in HG.iter_stream_actions(chunks, "s.hgen"):
+            ret.append((a.name, tuple(a.args), a.line, a.col))
+    except Exception as err:
+        return (type(err).__name__, str(err))
+    return ret
+
+class ParserTest(unittest.TestCase):
+    # script -> what parse_full gives for it
+    CASES = [
+        ("", []),
+        ("GENERATE_HEADERS(a, b, c)",
+            [("GENERATE_HEADERS", ("a", "b", "c"), 1, 1)]),
+        ("# comment\n\n  SET_FILE_EXT( h ) # more\n"
+            "GENERATE_HEADERS(\n a ,# x\n b\n)",
+            [("SET_FILE_EXT", ("h",), 3, 3),
+            ("GENERATE_HEADERS", ("a", "b"), 4, 1)]),
+        ("SET_MACRO_PREFIX()\nSET_FILE_PREFIX(include/)\n",
+            [("SET_MACRO_PREFIX", (), 1, 1),
+            ("SET_FILE_PREFIX", ("include/",), 2, 1)]),
+        # syntax errors
+        ("GENERATE_HEADERS(a,", ("HGenSyntaxError",
+            "s.hgen:1:1: unterminated GENERATE_HEADERS(...) at end of script")),
+        ("GENERATE_HEADERS(a b)", ("HGenSyntaxError",
+            "s.hgen:1:20: expected ',' or ')' in GENERATE_HEADERS(...), "
+            "found 'b'")),
+        ("GENERATE_HEADERS(,)", ("HGenSyntaxError",
+            "s.hgen:1:18: expected an argument to GENERATE_HEADERS, "
+            "found ','")),
+        ("GENERATE_HEADERS(a,)", ("HGenSyntaxError",
+            "s.hgen:1:20: expected an argument to GENERATE_HEADERS, "
+            "found ')'")),
+        ("GENERATE_HEADERS(a(b))", ("HGenSyntaxError",
+            "s.hgen:1:19: expected ',' or ')' in GENERATE_HEADERS(...), "
+            "found '('")),
+        ("SET_FILE_EXT(h)\nX", ("HGenSyntaxError",
+            "s.hgen:2:1: expected '(' after X at end of script")),
+        ("SET_FILE_EXT(h)\n  X Y", ("HGenSyntaxError",
+            "s.hgen:2:5: expected '(' after X, found 'Y'")),
+        (")", ("HGenSyntaxError",
+            "s.hgen:1:1: expected an action name, found ')'")),
+        ("A(", ("HGenSyntaxError",
+            "s.hgen:1:1: unterminated A(...) at end of script")),
+        # invalid actions
+        ("FOO(a)", ("InvalidActionError",
+            "s.hgen:1:1: FOO is not a valid Action!")),
+        ("SET_FILE_EXT(h)\n\nSET_JOBS()", ("InvalidArgumentError",
+            "s.hgen:3:1: SET_JOBS takes 1 argument(s), got 0")),
+        ("SET_JOBS(1,\n 2)", ("InvalidArgumentError",
+            "s.hgen:1:1: SET_JOBS takes 1 argument(s), got 2")),
+    ]
+
+    def test_parse(self):
+        for text, expected in self.CASES:
+            with self.subTest(script=text):
+                self.assertEqual(parse_full(text), expected)
+
+    def test_stream(self):
+        for text, expected in self.CASES:
+            for size in (1, 2, 3, 7, 64, 1 << 16):
+                with self.subTest(script=text, size=size):
+                    self.assertEqual(parse_stream(text, size), expected)
+
+"""
+
+Settings
+
+"""
+
+class HGenStateTest(TempDirTestCase):
+
+    def test_set(self):
+        state = HG.HGenState()
+        state.set("macro_prefix", "P")
+        self.assertEqual(state.macro_prefix, "P")
+        with self.assertRaises(TypeError):
+            state.set("jobs", "4")
+        with self.assertRaises(AttributeError):
+            state.set("nope", "")
+        # every run starts from its own defaults
+        self.assertEqual(HG.HGenState().macro_prefix, "")
+
+class ContextTest(TempDirTestCase):
+
+    def test_concurrent_runs(self):
+        from concurrent.futures import ThreadPoolExecutor
+        for i in range(12):
+            self.write("s{}.hgen".format(i), "SET_MACRO_PREFIX(P{0})\n"
+                "SET_FILE_PREFIX(out{0}/)\nSET_FILE_EXT(h{0})\n"
+                "GENERATE_HEADERS(a, b, c)\n".format(i))
+            os.makedirs("out{}".format(i))
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            list(pool.map(lambda i: HG.run_from_hgen_script(
+                "s{}.hgen".format(i), HG.HGenContext()), range(12)))
+        for i in range(12):
+            with open(os.path.join("out{}".format(i), "b.h{}".format(i))) as f:
+                self.assertTrue(f.read().startswith(
+                    "#ifndef P{}_b_H_\n".format(i)))
+
+"""
+
+Templates
+
+"""
+
+class TemplateTest(TempDirTestCase):
+    EVERY_SLOT = ("[{{LICENSE_BLOCK}}|{{LICENSE}}|{{MACRO_PREFIX}}|"
+        "{{FILE_PREFIX}}|{{FILE_EXT}}|{{GUARD}}|{{NAME}}|{{FILE}}|{{ NAME }}]")
+
+    def test_slots(self):
+        tmpl = HG.HeaderTemplate.compile(self.EVERY_SLOT)
+        self.assertEqual(tmpl.bind("P", "pre/", "h", "L").render("n"),
+            "[/*\nL\n*/\n\n|L|P|pre/|h|P_n_H_|n|pre/n.h|n]")
+        self.assertEqual(tmpl.bind("P", "pre/", "", "").render("n"),
+            "[||P|pre/||P_n_H_|n|pre/n|n]")
+
+    def test_default(self):
+        self.assertEqual(
+            HG.HeaderTemplate.default().bind("P", "", "H", "L").render("n"),
+            "/*\nL\n*/\n\n#ifndef P_n_H_\n#define P_n_H_\n\n#endif")
+
+    def test_guard_name(self):
+        tmpl = HG.HeaderTemplate.compile("{{GUARD}}|{{NAME}}|{{FILE}}")
+        for name, expected in (
+            ("a_1", "P_a_1_H_|a_1|a_1.H"),
+            ("foo-bar", "P_foo_bar_H_|foo-bar|foo-bar.H"),
+            ("my file.test", "P_my_file_test_H_|my file.test|my file.test.H"),
+            ("caf\u00e9", "P_caf__H_|caf\u00e9|caf\u00e9.H"),
+        ):
+            with self.subTest(name=name):
+                self.assertEqual(tmpl.bind("P", "", "H", "").render(name),
+                    expected)
+
+    def test_unknown_slot(self):
+        with self.assertRaises(HG.HGenSyntaxError) as cm:
+            HG.HeaderTemplate.compile("a\n  {{BAD}}", "t.tmpl")
+        self.assertEqual(str(cm.exception), "t.tmpl:2:3: unknown template "
+            "slot '{{BAD}}', expected one of LICENSE_BLOCK, LICENSE, "
+            "MACRO_PREFIX, FILE_PREFIX, FILE_EXT, GUARD, NAME, FILE")
+
+    def test_set_template_source(self):
+        self.write("t.tmpl", "// {{FILE}}\n")
+        self.write("s.hgen", "SET_TEMPLATE_SOURCE(t.tmpl)\nGENERATE_HEADERS(a)\n"
+            "SET_TEMPLATE_SOURCE()\nGENERATE_HEADERS(b)\n")
+        HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+        with open("a.H") as f:
+            self.assertEqual(f.read(), "// a.H\n")
+        with open("b.H") as f:
+            self.assertEqual(f.read(), "#ifndef _b_H_\n#define _b_H_\n\n#endif")
+
+"""
+
+Output
+
+"""
+
+class OutputModesTest(TempDirTestCase):
+    NAMES = ["h{}".format(i) for i in range(300)]
+
+    def setUp(self):
+        super().setUp()
+        self.write("notice.txt", "Copyright (c) test")
+        self.write("t.tmpl", "{{LICENSE_BLOCK}}#ifndef {{GUARD}}\n"
+            "#define {{GUARD}}\n/* {{NAME}} in {{FILE}} */\n#endif\n")
+
+    # runs script from a directory of its own, returning what it wrote
+    # to out/ in there
+    def run_mode(self, script: str, mode: str, **options) -> dict:
+        os.makedirs(os.path.join(mode, "out"))
+        os.chdir(mode)
+        try:
+            self.write("s.hgen", script)
+            # small chunks and shards, so names, actions and shards
+            # straddle them
+            with mock.patch.object(HG.HGenEnvars, "StreamChunkSize", 7), \
+                mock.patch.object(HG.HGenEnvars, "ShardSize", 64):
+                HG.run_from_hgen_script("s.hgen", HG.HGenContext(**options))
+        finally:
+            os.chdir(self.tmp)
+        return self.tree(os.path.join(mode, "out"))
+
+    def check_modes(self, script: str) -> None:
+        serial = self.run_mode(script, "serial")
+        self.assertTrue(serial)
+        for mode, options in (
+            ("jobs", {"jobs_override": 4}),
+            ("jobs_one", {"jobs_override": 1}),
+            ("stream", {"streaming": True}),
+            ("stream_jobs", {"streaming": True, "jobs_override": 4}),
+            ("shards", {"shards": 3}),
+            ("shards_jobs", {"shards": 2, "jobs_override": 2}),
+            ("stream_shards", {"streaming": True, "shards": 3}),
+        ):
+            with self.subTest(mode=mode):
+                self.assertEqual(self.run_mode(script, mode, **options),
+                    serial)
+
+    def test_plain(self):
+        self.check_modes(
+            "SET_MACRO_PREFIX(SDK)\nSET_FILE_PREFIX(out/)\n"
+            "SET_LICENSE_NOTICE_SOURCE(../notice.txt)\n"
+            "GENERATE_HEADERS(" + ", ".join(self.NAMES) + ")\n"
+            "SET_TEMPLATE_SOURCE(../t.tmpl)\nSET_FILE_EXT(hpp)\n"
+            "GENERATE_HEADERS(" + ", ".join(self.NAMES) + ")\n")
+
+    def test_configurations(self):
+        self.check_modes(
+            "SET_MACRO_PREFIX(SDK)\nSET_FILE_PREFIX(out/)\n"
+            "CONFIGURATION(c, FILE_EXT=h, LICENSE_NOTICE_SOURCE=../notice.txt)\n"
+            "CONFIGURATION(cpp, FILE_EXT=hpp, MACRO_PREFIX=SDKPP, "
+            "TEMPLATE_SOURCE=../t.tmpl)\n"
+            "GENERATE_HEADERS(" + ", ".join(self.NAMES) + ")\n")
+
+    def test_failures_in_input_order(self):
+        # a directory where a header should go can't be written
+        os.makedirs(os.path.join("out", "b.H"))
+        os.makedirs(os.path.join("out", "d.H"))
+        self.write("s.hgen", "SET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(a, b, c, d, e)\n")
+        for jobs, shards in ((1, 1), (4, 1), (1, 2)):
+            with self.subTest(jobs=jobs, shards=shards):
+                with self.assertRaises(HG.HeaderWriteError) as cm, \
+                    mock.patch.object(HG.HGenEnvars, "ShardSize", 2):
+                    HG.run_from_hgen_script("s.hgen",
+                        HG.HGenContext(jobs_override=jobs, shards=shards))
+                self.assertEqual([path for path, _ in cm.exception.failures],
+                    ["out/b.H", "out/d.H"])
+                for name in ("a", "c", "e"):
+                    self.assertTrue(os.path.isfile(
+                        os.path.join("out", name + ".H")))
+
+class SkipUnchangedTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write("s.hgen", "SET_MACRO_PREFIX(P)\nSET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(a, b, c)\n")
+        os.makedirs("out")
+
+    def run_script(self, jobs: int = None) -> HG.HGenRunStats:
+        return HG.run_from_hgen_script("s.hgen",
+            HG.HGenContext(jobs_override=jobs))
+
+    def test_rerun_leaves_headers_untouched(self):
+        stats = self.run_script()
+        self.assertEqual((stats.written, stats.unchanged), (3, 0))
+        then = 1000000000
+        for name in ("a", "b", "c"):
+            os.utime(os.path.join("out", name + ".H"), (then, then))
+        for jobs in (1, 4):
+            with self.subTest(jobs=jobs):
+                stats = self.run_script(jobs)
+                self.assertEqual((stats.written, stats.unchanged), (0, 3))
+                for name in ("a", "b", "c"):
+                    self.assertEqual(os.stat(
+                        os.path.join("out", name + ".H")).st_mtime, then)
+
+    def test_only_changed_headers_are_rewritten(self):
+        self.run_script()
+        self.write(os.path.join("out", "b.H"), "edited by hand")
+        stats = self.run_script()
+        self.assertEqual((stats.written, stats.unchanged), (1, 2))
+        with open(os.path.join("out", "b.H")) as f:
+            self.assertTrue(f.read().startswith("#ifndef P_b_H_\n"))
+
+        self.write("s.hgen", "SET_MACRO_PREFIX(Q)\nSET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(a, b, c)\n")
+        stats = self.run_script()
+        self.assertEqual((stats.written, stats.unchanged), (3, 0))
+
+class AtomicWriteTest(TempDirTestCase):
+
+    def test_keeps_permissions(self):
+        self.write("h.H", "old")
+        os.chmod("h.H", 0o640)
+        HG.Swrite_to("h.H", "new")
+        with open("h.H") as f:
+            self.assertEqual(f.read(), "new")
+        if os.name == "posix":
+            self.assertEqual(os.stat("h.H").st_mode & 0o777, 0o640)
+
+    def test_failure_keeps_old_file(self):
+        self.write("h.H", "old")
+        with mock.patch.object(HG.os, "replace",
+            side_effect=OSError("no space left")):
+            with self.assertRaises(OSError):
+                HG.Swrite_to("h.H", "new")
+        with open("h.H") as f:
+            self.assertEqual(f.read(), "old")
+        # the temporary file is gone too
+        self.assertEqual(os.listdir("."), ["h.H"])
+
+    def test_error_names_target(self):
+        target = os.path.join("missing", "h.H")
+        with self.assertRaises(FileNotFoundError) as cm:
+            HG.Swrite_to(target, "new")
+        self.assertEqual(cm.exception.filename, target)
+
+    def test_batch_syncs_once(self):
+        # c can't be written, a and b still get synced
+        self.write("s.hgen", "SET_DURABILITY(batch)\nSET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(a, b, c)\n")
+        os.makedirs(os.path.join("out", "c.H"))
+        with mock.patch.object(HG, "sync_outputs") as sync:
+            with self.assertRaises(HG.HeaderWriteError):
+                HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+        sync.assert_called_once()
+        self.assertEqual(sorted(sync.call_args[0][0]),
+            [os.path.join("out", "a.H"), os.path.join("out", "b.H")])
+
+    def test_sync_outputs(self):
+        a = self.write(os.path.join("out", "a.H"), "a")
+        b = self.write(os.path.join("out", "b.H"), "b")
+        os.chmod(a, 0o444)
+        with mock.patch.object(HG.os, "fsync") as fsync, \
+            mock.patch.object(HG.os, "sync", create=True) as sync:
+            HG.sync_outputs([a, b, a])
+        sync.assert_not_called()
+        # each file, then their directory
+        self.assertEqual(fsync.call_count,
+            3 if hasattr(os, "O_DIRECTORY") else 2)
+
+    def test_batch_synced_once_per_invocation(self):
+        for name in ("a", "b"):
+            self.write(name + ".hgen", "SET_DURABILITY(batch)\n"
+                "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS({})\n".format(name))
+        os.makedirs("out")
+        with mock.patch.object(HG, "sync_outputs") as sync:
+            results = HG.run_scripts_results(["a.hgen", "b.hgen"], processes=2)
+        sync.assert_called_once_with(
+            [os.path.join("out", "a.H"), os.path.join("out", "b.H")])
+        self.assertEqual([stats.unsynced for _, stats, _ in results], [[], []])
+
+    def test_file_durability(self):
+        self.write("s.hgen", "SET_DURABILITY(file)\nGENERATE_HEADERS(a)\n")
+        with mock.patch.object(HG.os, "fsync") as fsync:
+            HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+        self.assertTrue(fsync.called)
+        self.assertTrue(os.path.isfile("a.H"))
+
+"""
+
+Logging
+
+"""
+
+@unittest.skipUnless(__debug__, "nothing is logged with -O")
+class LoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        from collections import deque
+        logger = HG.Logger()
+        self.saved = (HG.Logger.level, logger.records)
+        HG.Logger.level = HG.LogLevel.get("DEBUG")
+        logger.records = deque(maxlen=3)
+
+    def tearDown(self):
+        HG.Logger.level, HG.Logger().records = self.saved
+
+    def log(self, *args, **kwargs) -> str:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            HG.Logger().print(*args, **kwargs)
+        return out.getvalue()
+
+    def test_ring_buffer(self):
+        for i in range(5):
+            self.log("f", "record {}", i)
+        self.assertEqual([HG.Logger.format(r) for r in HG.Logger().records],
+            ["FUNCTION f: record 2", "FUNCTION f: record 3",
+            "FUNCTION f: record 4"])
+
+    def test_levels(self):
+        self.assertEqual(self.log("f", "{} and {}", 1, 2), "FUNCTION f: 1 and 2\n")
+        self.assertEqual(self.log("f", "careful",
+            level=HG.LogLevel.get("WARNING")), "WARNING FUNCTION f: careful\n")
+        self.assertEqual(self.log(None, "plain",
+            level=HG.LogLevel.get("INFO")), "INFO: plain\n")
+
+    def test_dropped_records_are_never_formatted(self):
+        class Unformattable(object):
+            def __format__(self, spec):
+                raise AssertionError("formatted")
+        HG.Logger.level = HG.LogLevel.get("WARNING")
+        self.assertEqual(self.log("f", "{}", Unformattable()), "")
+        self.assertEqual(len(HG.Logger().records), 0)
+
+    def test_from_name(self):
+        self.assertEqual(HG.LogLevel.from_name("warning"),
+            HG.LogLevel.get("WARNING"))
+        with self.assertRaises(HG.InvalidArgumentError):
+            HG.LogLevel.from_name("LOUD")
+
+    def test_singletons_follow_the_level(self):
+        class Single(HG.SingletonBase):
+            pass
+        self.assertTrue(self.log_singleton(Single))
+        HG.Logger.level = HG.LogLevel.get("INFO")
+        self.assertEqual(self.log_singleton(Single), "")
+
+    def log_singleton(self, cls) -> str:
+        cls.single_instance = None
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            cls()
+        return out.getvalue()
+
+class CommandLineLogTest(TempDirTestCase):
+
+    # the level is set before the first singleton is created
+    def test_log_level(self):
+        import subprocess
+        self.write("s.hgen", "GENERATE_HEADERS(a)\n")
+        out = subprocess.run([sys.executable, HG.__file__, "--run", "s.hgen",
+            "--log-level", "ERROR"], capture_output=True, text=True,
+            env=dict(os.environ, HGEN_CACHE_DIR=HG.PlanCache().directory))
+        self.assertEqual((out.returncode, out.stdout, out.stderr),
+            (0, "1 header(s) written, 0 unchanged\n", ""))
+
+"""
+
+Batches
+
+"""
+
+class BatchTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs("out")
+        self.write(os.path.join("scripts", "a.hgen"),
+            "SET_MACRO_PREFIX(A)\nSET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(a1, a2)\n")
+        self.write(os.path.join("scripts", "b.hgen"),
+            "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS(b1)\n")
+        self.write(os.path.join("scripts", "sub", "c.hgen"), "NOPE(x)\n")
+        self.write(os.path.join("scripts", "notes.txt"), "")
+
+    def test_expand_script_paths(self):
+        a = os.path.join("scripts", "a.hgen")
+        b = os.path.join("scripts", "b.hgen")
+        c = os.path.join("scripts", "sub", "c.hgen")
+        self.assertEqual(HG.expand_script_paths(["scripts"]), [a, b, c])
+        self.assertEqual(HG.expand_script_paths(
+            [b, os.path.join("scripts", "*.hgen"), "x.hgen"]), [b, a, "x.hgen"])
+
+    def test_scripts_run_from_fresh_settings(self):
+        self.assertEqual(HG.run_scripts(
+            HG.expand_script_paths(["scripts"]), processes=2), 1)
+        with open(os.path.join("out", "a2.H")) as f:
+            self.assertEqual(f.readline(), "#ifndef A_a2_H_\n")
+        # b.hgen doesn't see a.hgen's SET_MACRO_PREFIX
+        with open(os.path.join("out", "b1.H")) as f:
+            self.assertEqual(f.readline(), "#ifndef _b1_H_\n")
+
+    def test_failure_is_reported_not_raised(self):
+        xfile, stats, err = HG.run_script_isolated(
+            os.path.join("scripts", "sub", "c.hgen"))
+        self.assertEqual(err, "InvalidActionError: "
+            "scripts/sub/c.hgen:1:1: NOPE is not a valid Action!")
+        self.assertEqual(stats.written, 0)
+
+"""
+
+License notices
+
+"""
+
+class LicenseCacheTest(TempDirTestCase):
+
+    def test_load(self):
+        cache = HG.LicenseCache()
+        with open("notice.txt", "wb") as f:
+            f.write(b"line one\r\nline two\r\n")
+        self.assertEqual(cache.load("notice.txt"),
+            ("line one\nline two\n", False))
+        self.assertEqual(cache.load("notice.txt"),
+            ("line one\nline two\n", True))
+        self.write("notice.txt", "a longer notice\n")
+        self.assertEqual(cache.load("notice.txt"), ("a longer notice\n", False))
+        self.write("empty.txt", "")
+        self.assertEqual(cache.load("empty.txt"), ("", False))
+
+    def test_counted_per_run(self):
+        self.write("notice.txt", "Copyright (c) test")
+        self.write("s.hgen", "SET_LICENSE_NOTICE_SOURCE(notice.txt)\n"
+            "GENERATE_HEADERS(a)\nSET_LICENSE_NOTICE_SOURCE(notice.txt)\n"
+            "GENERATE_HEADERS(b)\n")
+        stats = HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+        self.assertEqual((stats.license_hits, stats.license_misses), (1, 1))
+        with open("b.H") as f:
+            self.assertTrue(f.read().startswith("/*\nCopyright (c) test\n*/"))
+
+"""
+
+Configurations
+
+"""
+
+class ConfigurationTest(TempDirTestCase):
+
+    def test_variants(self):
+        out = HG.generate("SET_MACRO_PREFIX(SDK)\n"
+            "CONFIGURATION(c, FILE_EXT=h)\n"
+            "CONFIGURATION(cpp, FILE_EXT=hpp, MACRO_PREFIX=SDKPP)\n"
+            "GENERATE_HEADERS(socket, packet)\n")
+        self.assertEqual(sorted(out),
+            ["packet.h", "packet.hpp", "socket.h", "socket.hpp"])
+        self.assertTrue(out["socket.h"].startswith("#ifndef SDK_socket_H_\n"))
+        self.assertTrue(
+            out["socket.hpp"].startswith("#ifndef SDKPP_socket_H_\n"))
+
+    def test_written_once_per_configuration(self):
+        self.write("s.hgen", "CONFIGURATION(a, FILE_PREFIX=a/)\n"
+            "CONFIGURATION(b, FILE_PREFIX=b/)\nGENERATE_HEADERS(x, y)\n")
+        os.makedirs("a")
+        os.makedirs("b")
+        stats = HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+        self.assertEqual(stats.outputs, ["a/x.H", "b/x.H", "a/y.H", "b/y.H"])
+        self.assertEqual(stats.written, 4)
+
+    def test_errors(self):
+        for script, message in (
+            ("CONFIGURATION(a)\nCONFIGURATION(a)\n",
+                "s.hgen:2:1: configuration a is already defined"),
+            ("CONFIGURATION(a, JOBS=2)\n",
+                "s.hgen:1:1: expected KEY=value with KEY one of MACRO_PREFIX, "
+                "FILE_PREFIX, FILE_EXT, LICENSE_NOTICE_SOURCE, TEMPLATE_SOURCE, "
+                "got 'JOBS=2'"),
+            ("CONFIGURATION(a, MACRO_PREFIX=A)\n"
+                "CONFIGURATION(b, MACRO_PREFIX=B)\n",
+                "s.hgen:2:1: configurations a and b would both write "
+                "NAME.H, give them different FILE_PREFIX or FILE_EXT values"),
+            # only once a SET_* made them the same
+            ("CONFIGURATION(a, FILE_EXT=h)\nCONFIGURATION(b)\n"
+                "SET_FILE_EXT(h)\nGENERATE_HEADERS(x)\n",
+                "s.hgen:4:1: configurations a and b would both write NAME.h"),
+        ):
+            with self.subTest(script=script):
+                self.write("s.hgen", script)
+                with self.assertRaises(HG.InvalidArgumentError) as cm:
+                    HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+                self.assertEqual(str(cm.exception), message)
+
+"""
+
+GENERATE_HEADERS_FROM
+
+"""
+
+class GenerateFromTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for path in ("x.c", "y.c", "notes.txt", os.path.join("sub", "x.c"),
+            os.path.join("sub", "z.h"), os.path.join(".hidden", "w.c")):
+            self.write(os.path.join("src", path), "")
+        os.makedirs("out")
+
+    def run_script(self, args: str) -> HG.HGenRunStats:
+        self.write("s.hgen", "SET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS_FROM(" + args + ")\n")
+        return HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+
+    def test_patterns(self):
+        for args, names in (
+            ("src, *.c", ["x", "y"]),
+            ("src, *.c, *.h", ["x", "y", "z"]),
+            ("src", ["notes", "x", "y", "z"]),
+        ):
+            with self.subTest(args=args):
+                stats = self.run_script(args)
+                # every directory scanned, for the BuildIndex
+                self.assertEqual(stats.inputs,
+                    ["s.hgen", "src", os.path.join("src", "sub")])
+                self.assertEqual(sorted(stats.outputs),
+                    ["out/{}.H".format(n) for n in names])
+                self.assertEqual(sorted(os.listdir("out")),
+                    ["{}.H".format(n) for n in names])
+                shutil.rmtree("out")
+                os.makedirs("out")
+
+    def test_guards(self):
+        self.write(os.path.join("src", "foo-bar.c"), "")
+        self.run_script("src, *.c")
+        with open(os.path.join("out", "foo-bar.H")) as f:
+            self.assertTrue(f.read().startswith("#ifndef _foo_bar_H_\n"))
+
+    def test_not_a_directory(self):
+        with self.assertRaises(HG.InvalidArgumentError) as cm:
+            self.run_script("nope")
+        self.assertEqual(str(cm.exception),
+            "s.hgen:2:1: nope is not a directory")
+
+"""
+
+INCLUDE
+
+"""
+
+class IncludeTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        HG.IncludeCache().entries.clear()
+        self.write(os.path.join("scripts", "main.hgen"),
+            "INCLUDE(common/pre.hgen)\nGENERATE_HEADERS(a)\n")
+        self.write(os.path.join("scripts", "common", "pre.hgen"),
+            "SET_MACRO_PREFIX(PRE)\nSET_FILE_PREFIX(out/)\n")
+        os.makedirs("out")
+
+    def test_relative_to_script(self):
+        stats = HG.run_from_hgen_script(os.path.join("scripts", "main.hgen"),
+            HG.HGenContext())
+        self.assertEqual(stats.inputs, [os.path.join("scripts", "main.hgen"),
+            os.path.join("scripts", "common", "pre.hgen")])
+        with open(os.path.join("out", "a.H")) as f:
+            self.assertTrue(f.read().startswith("#ifndef PRE_a_H_\n"))
+
+    def test_cache_hit(self):
+        main = os.path.join("scripts", "main.hgen")
+        with mock.patch.object(HG, "load_plan", wraps=HG.load_plan) as load:
+            HG.run_from_hgen_script(main, HG.HGenContext())
+            self.assertEqual(load.call_count, 2)
+            HG.run_from_hgen_script(main, HG.HGenContext())
+            # only main.hgen itself
+            self.assertEqual(load.call_count, 3)
+
+    def test_cycle(self):
+        self.write("a.hgen", "INCLUDE(b.hgen)\n")
+        self.write("b.hgen", "\n  INCLUDE(a.hgen)\n")
+        with self.assertRaises(HG.InvalidArgumentError) as cm:
+            HG.run_from_hgen_script("a.hgen", HG.HGenContext())
+        self.assertEqual(str(cm.exception),
+            "b.hgen:2:3: INCLUDE cycle: a.hgen -> b.hgen -> a.hgen")
+
+    def test_missing(self):
+        self.write("a.hgen", "INCLUDE(nope.hgen)\n")
+        with self.assertRaises(HG.InvalidArgumentError) as cm:
+            HG.run_from_hgen_script("a.hgen", HG.HGenContext())
+        self.assertTrue(str(cm.exception).startswith(
+            "a.hgen:1:1: cannot INCLUDE nope.hgen: "))
+
+"""
+
+Async runs
+
+"""
+
+class AsyncTest(TempDirTestCase):
+
+    NAMES = ["h{}".format(i) for i in range(20)]
+
+    def setUp(self):
+        super().setUp()
+        self.write("s.hgen", "SET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(" + ", ".join(self.NAMES) + ")\n")
+        os.makedirs("out")
+
+    def run_async(self, **kwargs) -> HG.HGenRunStats:
+        import asyncio
+        return asyncio.run(HG.run_script_async("s.hgen", **kwargs))
+
+    def test_run(self):
+        stats = self.run_async(state={"macro_prefix": "Z"})
+        self.assertEqual((stats.written, stats.unchanged), (20, 0))
+        self.assertEqual(stats.inputs, ["s.hgen"])
+        with open(os.path.join("out", "h3.H")) as f:
+            self.assertTrue(f.read().startswith("#ifndef Z_h3_H_\n"))
+        # the command line's settings are left alone
+        self.assertEqual(HG.default_context().state.macro_prefix, "")
+        stats = self.run_async(state={"macro_prefix": "Z"})
+        self.assertEqual((stats.written, stats.unchanged), (0, 20))
+
+    def test_max_writes(self):
+        import threading
+        import time
+        lock = threading.Lock()
+        running = [0, 0] # now, most at once
+        real = HG.write_templated_header
+
+        def write(*args):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            try:
+                return real(*args)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        with mock.patch.object(HG, "write_templated_header", write):
+            self.run_async(max_writes=3)
+        self.assertLessEqual(running[1], 3)
+        self.assertEqual(len(os.listdir("out")), 20)
+        with self.assertRaises(HG.InvalidArgumentError):
+            self.run_async(max_writes=0)
+
+    def test_failures(self):
+        os.makedirs(os.path.join("out", "h12.H"))
+        os.makedirs(os.path.join("out", "h5.H"))
+        with self.assertRaises(HG.HeaderWriteError) as cm:
+            self.run_async(max_writes=4)
+        self.assertEqual([path for path, _ in cm.exception.failures],
+            ["out/h5.H", "out/h12.H"])
+        # every other header was still written
+        self.assertEqual(len([n for n in os.listdir("out")
+            if os.path.isfile(os.path.join("out", n))]), 18)
+
+"""
+
+Depfiles and manifests
+
+"""
+
+class BuildFilesTest(TempDirTestCase):
+
+    def test_depfile_escape(self):
+        for path, expected in (
+            ("a/b.H", "a/b.H"),
+            ("my dir/a.H", "my\\ dir/a.H"),
+            ("a#1.H", "a\\#1.H"),
+            ("$x.H", "$$x.H"),
+        ):
+            with self.subTest(path=path):
+                self.assertEqual(HG.depfile_escape(path), expected)
+
+    def test_run(self):
+        import json
+        self.write("notice.txt", "// notice\n")
+        self.write("my script.hgen", "SET_LICENSE_NOTICE_SOURCE(notice.txt)\n"
+            "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS(a, b)\n")
+        self.write("t.hgen", "SET_LICENSE_NOTICE_SOURCE(notice.txt)\n"
+            "GENERATE_HEADERS(c)\n")
+        os.makedirs("out")
+        self.assertEqual(HG.act_on_parse(["--run", "my script.hgen", "t.hgen",
+            "--depfile", "h.d", "--manifest", "h.json"]), 0)
+        with open("h.d") as f:
+            self.assertEqual(f.read(), "out/a.H out/b.H c.H h.json: "
+                "my\\ script.hgen \\\n  notice.txt \\\n  t.hgen\n")
+        with open("h.json") as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["inputs"],
+            ["my script.hgen", "notice.txt", "t.hgen"])
+        self.assertEqual(manifest["outputs"], ["out/a.H", "out/b.H", "c.H"])
+        self.assertEqual(manifest["scripts"]["t.hgen"],
+            {"inputs": ["t.hgen", "notice.txt"], "outputs": ["c.H"]})
+
+    def test_not_written_on_failure(self):
+        self.write("s.hgen", "NOPE()\n")
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(HG.act_on_parse(
+                ["--run", "s.hgen", "--depfile", "h.d"]), 1)
+        self.assertFalse(os.path.exists("h.d"))
+
+"""
+
+Profiling
+
+"""
+
+class ProfilerTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        HG.Profiler().reset()
+        os.makedirs("out")
+        self.write("a.hgen", "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS(a1, a2)\n")
+        self.write("b.hgen", "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS(b1)\n")
+
+    def tearDown(self):
+        HG.Profiler().reset()
+        super().tearDown()
+
+    def test_phases(self):
+        import json
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(HG.run_scripts_profiled(["a.hgen", "b.hgen"],
+                processes=2, json_file="p.json", trace_file="t.json"), 0)
+        self.assertFalse(HG.Profiler.enabled)
+        with open("p.json") as f:
+            phases = json.load(f)["phases"]
+        # counted in the workers, merged here
+        self.assertEqual(phases["run_from_hgen_script"]["calls"], 2)
+        self.assertEqual(phases["generate_templated_header"]["calls"], 3)
+        self.assertGreater(phases["Swrite_if_changed"]["bytes_written"], 0)
+        self.assertGreater(phases["Sread_from"]["bytes_read"], 0)
+        with open("t.json") as f:
+            events = json.load(f)["traceEvents"]
+        self.assertIn("run_from_hgen_script", {e["name"] for e in events})
+
+"""
+
+Plan cache
+
+"""
+
+class PlanCacheTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write("s.hgen", "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS(a, b)\n")
+        os.makedirs("out")
+
+    def entries(self) -> list:
+        d = HG.PlanCache().directory
+        if not os.path.isdir(d):
+            return []
+        return sorted(e for e in os.listdir(d) if e.endswith(".hgenc"))
+
+    # runs s.hgen, returning how often it had to be parsed
+    def run_counting_parses(self) -> int:
+        with mock.patch.object(HG, "parse_script",
+            wraps=HG.parse_script) as parse:
+            HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+        return parse.call_count
+
+    def test_hit(self):
+        self.assertEqual(self.run_counting_parses(), 1)
+        self.assertEqual(len(self.entries()), 1)
+        os.remove(os.path.join("out", "a.H"))
+        self.assertEqual(self.run_counting_parses(), 0)
+        self.assertTrue(os.path.isfile(os.path.join("out", "a.H")))
+
+    def test_cached_plan_keeps_locations(self):
+        self.run_counting_parses()
+        key = HG.PlanCache().key_for("SET_FILE_PREFIX(out/)\n"
+            "GENERATE_HEADERS(a, b)\n")
+        actions = HG.PlanCache().load(key, "other.hgen")
+        self.assertEqual([a.location() for a in actions],
+            ["other.hgen:1:1", "other.hgen:2:1"])
+
+    def test_corrupt_entry_is_a_miss(self):
+        self.run_counting_parses()
+        path = os.path.join(HG.PlanCache().directory, self.entries()[0])
+        for dat in (b"", b"garbage", b"HGENC1\n\xff\x00"):
+            with self.subTest(entry=dat):
+                with open(path, "wb") as f:
+                    f.write(dat)
+                self.assertEqual(self.run_counting_parses(), 1)
+                self.assertEqual(self.run_counting_parses(), 0)
+
+    def test_code_change(self):
+        self.run_counting_parses()
+        with mock.patch.object(HG, "_CODE_VERSION", "other code"):
+            self.assertEqual(self.run_counting_parses(), 1)
+
+    def test_code_version(self):
+        import hashlib
+        with open(HG.__file__, "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        with mock.patch.object(HG, "_CODE_VERSION", None):
+            self.assertEqual(HG.code_version(), digest)
+        st = os.stat(sys.executable)
+        with mock.patch.object(HG, "_CODE_VERSION", None), \
+            mock.patch.object(sys, "frozen", True, create=True):
+            self.assertEqual(HG.code_version(), "{}:{}:{}".format(
+                sys.executable, st.st_size, st.st_mtime_ns))
+
+    def test_prune(self):
+        cache = HG.PlanCache()
+        saved = cache.max_entries
+        cache.max_entries = 3
+        try:
+            for i in range(5):
+                self.write("s.hgen", "GENERATE_HEADERS(out/h{})\n".format(i))
+                self.run_counting_parses()
+                self.assertEqual(len(self.entries()), min(i + 1, 3))
+        finally:
+            cache.max_entries = saved
+        # the latest plan is one of those kept
+        self.assertEqual(self.run_counting_parses(), 0)
+
+    def test_no_cache(self):
+        with mock.patch.object(HG, "parse_script",
+            wraps=HG.parse_script) as parse:
+            HG.act_on_parse(["--no-cache", "--run", "s.hgen"])
+            HG.act_on_parse(["--no-cache", "--run", "s.hgen"])
+        self.assertEqual(parse.call_count, 2)
+        self.assertEqual(self.entries(), [])
+
+"""
+
+Build index
+
+"""
+
+class BuildIndexTest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.write("notice.txt", "// notice\n")
+        self.write("s.hgen", "SET_LICENSE_NOTICE_SOURCE(notice.txt)\n"
+            "SET_FILE_PREFIX(out/)\nGENERATE_HEADERS(a, b)\n")
+        os.makedirs("out")
+        self.age("notice.txt", "s.hgen")
+
+    # inputs modified right before a run never count as up to date
+    def age(self, *paths):
+        then = os.stat(paths[0]).st_mtime - 60
+        for p in paths:
+            os.utime(p, (then, then))
+
+    def run_script(self) -> HG.HGenRunStats:
+        return HG.run_from_hgen_script("s.hgen", HG.HGenContext())
+
+    def test_up_to_date(self):
+        self.assertFalse(self.run_script().up_to_date)
+        with mock.patch.object(HG, "parse_script") as parse:
+            stats = self.run_script()
+        parse.assert_not_called()
+        self.assertTrue(stats.up_to_date)
+        self.assertEqual((stats.written, stats.unchanged), (0, 2))
+        self.assertEqual(stats.outputs, ["out/a.H", "out/b.H"])
+
+    def test_changes(self):
+        self.run_script()
+        for change in ("script", "license", "header deleted"):
+            with self.subTest(change=change):
+                if change == "script":
+                    with open("s.hgen", "a") as f:
+                        f.write("GENERATE_HEADERS(c)\n")
+                    self.age("s.hgen")
+                    expected = (1, 2)
+                elif change == "license":
+                    self.write("notice.txt", "// other notice\n")
+                    self.age("notice.txt")
+                    expected = (3, 0)
+                else:
+                    os.remove(os.path.join("out", "b.H"))
+                    expected = (1, 2)
+                stats = self.run_script()
+                self.assertFalse(stats.up_to_date)
+                self.assertEqual((stats.written, stats.unchanged), expected)
+                self.assertTrue(self.run_script().up_to_date)
+
+    def test_known_headers_are_not_read_back(self):
+        self.run_script()
+        with open("s.hgen", "a") as f:
+            f.write("# nothing\n")
+        self.age("s.hgen")
+        with mock.patch.object(HG, "Sis_same_on_disk") as same:
+            stats = self.run_script()
+        same.assert_not_called()
+        self.assertEqual((stats.up_to_date, stats.written, stats.unchanged),
+            (False, 0, 2))
+
+    def test_starting_settings(self):
+        self.run_script()
+        state = HG.HGenState()
+        state.set("macro_prefix", "Q")
+        stats = HG.run_from_hgen_script("s.hgen", HG.HGenContext(state))
+        self.assertFalse(stats.up_to_date)
+        self.assertEqual(stats.written, 2)
+        with open(os.path.join("out", "a.H")) as f:
+            self.assertIn("#ifndef Q_a_H_\n", f.read())
+        # equal settings, equal key
+        state = HG.HGenState()
+        state.set("macro_prefix", "Q")
+        state.set("template", HG.HeaderTemplate.default())
+        self.assertTrue(HG.run_from_hgen_script("s.hgen",
+            HG.HGenContext(state)).up_to_date)
+
+    def test_code_change(self):
+        # older code, which rendered headers differently
+        with mock.patch.object(HG, "_CODE_VERSION", "older code"), \
+            mock.patch.object(HG, "generate_templated_header",
+            lambda *args: "older\n"):
+            self.run_script()
+            self.assertTrue(self.run_script().up_to_date)
+        stats = self.run_script()
+        self.assertEqual((stats.up_to_date, stats.written), (False, 2))
+        with open(os.path.join("out", "a.H")) as f:
+            self.assertIn("#ifndef _a_H_\n", f.read())
+
+    def test_racy_inputs(self):
+        self.write("notice.txt", "// just now\n")
+        self.run_script()
+        self.assertFalse(self.run_script().up_to_date)
+
+    def test_no_cache(self):
+        HG.PlanCache().enabled = False
+        self.run_script()
+        self.assertFalse(self.run_script().up_to_date)
+        self.assertFalse(os.path.exists(HG.PlanCache().directory))
+
+"""
+
+Watch mode
+
+"""
+
+class WatcherTest(TempDirTestCase):
+
+    def watchers(self):
+        yield HG.PollWatcher(0.01)
+        if sys.platform.startswith("linux"):
+            yield HG.InotifyWatcher()
+
+    def test_changes(self):
+        a = os.path.abspath(self.write("a.txt", "a"))
+        b = os.path.abspath(self.write(os.path.join("sub", "b.txt"), "b"))
+        other = self.write("other.txt", "")
+        for watcher in self.watchers():
+            with self.subTest(watcher=type(watcher).__name__):
+                try:
+                    watcher.watch({a, b})
+                    self.write(a, "a changed")
+                    self.assertEqual(HG.wait_for_changes(watcher, 0.1), {a})
+                    # saved the way editors do, by replacing the file
+                    self.write(b + ".tmp", "b changed")
+                    os.replace(b + ".tmp", b)
+                    self.assertEqual(HG.wait_for_changes(watcher, 0.1), {b})
+                    self.write(other, "not watched")
+                    self.assertEqual(watcher.poll(0.1), set())
+                finally:
+                    watcher.close()
+
+    # what GENERATE_HEADERS_FROM scanned
+    def test_directories(self):
+        src = os.path.abspath("src")
+        self.write(os.path.join(src, "a.c"), "")
+        for watcher in self.watchers():
+            with self.subTest(watcher=type(watcher).__name__):
+                try:
+                    watcher.watch({src})
+                    self.write(os.path.join(src, "b.c"), "")
+                    self.assertEqual(watcher.poll(5), {src})
+                    os.rename(os.path.join(src, "b.c"),
+                        os.path.join(src, "c.c"))
+                    self.assertEqual(watcher.poll(5), {src})
+                    os.remove(os.path.join(src, "c.c"))
+                    self.assertEqual(watcher.poll(5), {src})
+                    # the names are all that's read from it
+                    self.write(os.path.join(src, "a.c"), "int a;")
+                    self.assertEqual(watcher.poll(0.1), set())
+                finally:
+                    watcher.close()
+
+"""
+
+Library API
+
+"""
+
+class GenerateTest(TempDirTestCase):
+
+    SCRIPT = ("SET_MACRO_PREFIX(P)\nSET_FILE_PREFIX(inc/)\n"
+        "GENERATE_HEADERS(a, b)\n")
+
+    def test_generate(self):
+        out = HG.generate(self.SCRIPT)
+        self.assertEqual(list(out), ["inc/a.H", "inc/b.H"])
+        self.assertTrue(out["inc/a.H"].startswith("#ifndef P_a_H_\n"))
+        # nothing is written
+        self.assertEqual(os.listdir("."), [])
+
+    def test_state(self):
+        out = HG.generate("GENERATE_HEADERS(a)\n",
+            state={"file_ext": "hpp", "macro_prefix": "Q"})
+        self.assertTrue(out["a.hpp"].startswith("#ifndef Q_a_H_\n"))
+        with self.assertRaises(TypeError):
+            HG.generate("GENERATE_HEADERS(a)\n", state={"jobs": "2"})
+
+    def test_settings_are_left_alone(self):
+        state = HG.default_context().state
+        HG.generate(self.SCRIPT)
+        self.assertEqual((state.macro_prefix, state.file_prefix), ("", ""))
+
+    def test_include(self):
+        self.write(os.path.join("lib", "pre.hgen"), "SET_MACRO_PREFIX(LIB)\n")
+        script = "INCLUDE(pre.hgen)\nGENERATE_HEADERS(a)\n"
+        self.write(os.path.join("lib", "lib.hgen"), script)
+        # relative to source, when it's a file
+        out = HG.generate(script, source=os.path.join("lib", "lib.hgen"))
+        self.assertTrue(out["a.H"].startswith("#ifndef LIB_a_H_\n"))
+        with self.assertRaises(HG.InvalidArgumentError) as cm:
+            HG.generate(script, source="lib.hgen")
+        self.assertTrue(str(cm.exception).startswith(
+            "lib.hgen:1:1: cannot INCLUDE pre.hgen: "))
+        # the plan cache directory is left alone
+        self.assertFalse(os.path.exists(HG.PlanCache().directory))
+
+    def test_iter_generate(self):
+        # errors are raised right away, not on the first next()
+        with self.assertRaises(HG.InvalidActionError) as cm:
+            HG.iter_generate("NOPE()\n", source="x.hgen")
+        self.assertIn("x.hgen:1:1", str(cm.exception))
+
+        it = HG.iter_generate(self.SCRIPT)
+        path, text = next(it)
+        self.assertEqual(path, "inc/a.H")
+        self.assertEqual([p for p, _ in it], ["inc/b.H"])
+
+"""
+
+Server mode
+
+"""
+
+@unittest.skipUnless(hasattr(__import__("socket"), "AF_UNIX"),
+    "needs Unix domain sockets")
+class ServerTest(TempDirTestCase):
+
+    def test_round_trip(self):
+        import threading
+        import time
+        path = os.path.join(self.tmp, "hgen.sock")
+        self.addCleanup(setattr, HG.PlanCache(), "memory", None)
+        self.write("s.hgen", "SET_MACRO_PREFIX(S)\nGENERATE_HEADERS(a)\n")
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            server = threading.Thread(target=HG.act_on_parse,
+                args=(["--serve", path, "--idle-timeout", "1"],))
+            server.start()
+            for _ in range(500):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+
+            self.assertEqual(HG.act_on_parse(
+                ["--connect", path, "--run", "s.hgen"]), 0)
+            with open("a.H") as f:
+                self.assertTrue(f.read().startswith("#ifndef S_a_H_\n"))
+            with contextlib.redirect_stderr(io.StringIO()) as err:
+                self.assertEqual(HG.run_via_server(["--watch"], path), 2)
+            self.assertIn("--watch is not available", err.getvalue())
+            # the server stops on its own once idle
+            server.join(10)
+        self.assertFalse(server.is_alive())
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(HG.run_via_server(["--run", "s.hgen"], path))
+
+if __name__ == "__main__":
+    unittest.main()